@@ -0,0 +1,233 @@
+import argparse
+import os
+import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.collections import PathCollection
+from matplotlib.colors import BoundaryNorm
+from matplotlib.path import Path
+from PIL import Image
+from shapely.geometry.polygon import orient
+import census
+import constants
+import main
+import map_plot
+import metrics
+from manifest import Manifest
+
+# Renders one raster frame per census year, with optional interpolated frames between years, and assembles them into
+# an animated gif or mp4. Geometry is projected and converted to matplotlib paths once per geography and cached, so
+# each frame only costs setting the fill colours.
+_CRS = "EPSG:3347"
+_COLOUR_MAP = "YlGnBu"
+_NAN_COLOUR = "white"
+_EDGE_COLOUR = (0, 0, 0, 0.2)
+_FIGURE_SIZE = (10, 8)
+_DPI = 100
+
+# The figure of each worker process, see _init_renderer
+_renderer = None
+
+
+def get_paths(type):
+    """
+    Gets the geometry of a type of census geography as projected matplotlib paths. Paths are cached to a file, which
+    is rebuilt when the boundary file changes.
+    :param type: A string representing the type of geography desired: "Census Subdivisions", "Census Divisions", or "Provinces"
+    :return: The filename of a pickle holding the geocodes, the paths, and the extent of the geography
+    """
+    filename = os.path.join(constants.CACHE_DIR, f"{type} paths.pickle")
+    manifest = Manifest()
+    boundaries = map_plot.get_cad_filename(type, _FIGURE_SIZE[0] * _DPI)
+    inputs = {"boundaries": boundaries, "hash": manifest.fingerprint(boundaries), "crs": _CRS}
+
+    if not manifest.is_current("animation", type, inputs, [filename]):
+        print(f"Preparing paths for {type}")
+        geo_level = map_plot.get_property_names(type)[0]
+        cad = map_plot.get_cad_file(type, _FIGURE_SIZE[0] * _DPI).to_crs(_CRS)
+
+        paths = []
+        for geometry in cad.geometry:
+            rings = []
+            polygons = [] if geometry is None else getattr(geometry, "geoms", [geometry])
+            for polygon in polygons:
+                # Exteriors and interiors wind in opposite directions so that holes are left unfilled
+                polygon = orient(polygon)
+                rings.append(Path(np.asarray(polygon.exterior.coords)[:, :2], closed=True))
+                rings.extend(Path(np.asarray(interior.coords)[:, :2], closed=True) for interior in polygon.interiors)
+            paths.append(Path.make_compound_path(*rings) if rings else Path(np.empty((0, 2))))
+
+        os.makedirs(constants.CACHE_DIR, exist_ok=True)
+        with open(filename, "wb") as file:
+            pickle.dump({"geocodes": cad[geo_level].to_numpy(), "paths": paths, "extent": cad.total_bounds}, file)
+        manifest.record("animation", type, inputs, [filename])
+
+    return filename
+
+
+def _init_renderer(paths_filename, thresholds, legend_name):
+    """
+    Creates the figure of a worker process, which is reused for every frame it renders
+    :param paths_filename: The filename of the cached paths, see get_paths
+    :param thresholds: The thresholds of the colour scale, shared by all frames
+    :param legend_name: The name applied to the legend
+    :return: None
+    """
+    global _renderer
+
+    with open(paths_filename, "rb") as file:
+        geography = pickle.load(file)
+
+    fig, ax = plt.subplots(figsize=_FIGURE_SIZE, dpi=_DPI)
+    ax.set_axis_off()
+    ax.set_aspect("equal")
+    min_x, min_y, max_x, max_y = geography["extent"]
+    ax.set_xlim(min_x, max_x)
+    ax.set_ylim(min_y, max_y)
+
+    cmap = plt.get_cmap(_COLOUR_MAP).copy()
+    cmap.set_bad(_NAN_COLOUR)
+    collection = PathCollection(geography["paths"], cmap=cmap, norm=BoundaryNorm(thresholds, cmap.N),
+                                edgecolors=_EDGE_COLOUR, linewidths=0.1)
+    ax.add_collection(collection)
+    fig.colorbar(collection, ax=ax, orientation="horizontal", fraction=0.04, pad=0.02, label=legend_name)
+    title = ax.set_title("")
+
+    _renderer = {"fig": fig, "collection": collection, "title": title}
+
+
+def _render_frame(values, label, filename):
+    """
+    Renders a single frame with the figure of the worker process
+    :param values: An array of the value of each geography, in the order of the cached paths
+    :param label: The title of the frame
+    :param filename: The png file the frame is saved to
+    :return: The filename
+    """
+    _renderer["collection"].set_array(np.ma.masked_invalid(values))
+    _renderer["title"].set_text(label)
+    _renderer["fig"].savefig(filename)
+    return filename
+
+
+def get_frames(cad, geo_level, geocodes, columns, years, steps=0):
+    """
+    Gets the values and titles of each frame, linearly interpolating frames between consecutive years. Interpolated
+    frames are titled with the pair of years they lie between, so they are not mistaken for census data
+    :param cad: The geopandas dataframe holding a column of data for each year
+    :param geo_level: The column of the dataframe holding geocodes
+    :param geocodes: The geocodes of the cached paths, which values are ordered by
+    :param columns: The names of the columns of data for each year
+    :param years: The census years, used to title the frames
+    :param steps: The number of interpolated frames to add between each pair of years
+    :return: A list of tuples of the values and the title of each frame
+    """
+    values = [cad.set_index(geo_level)[column].reindex(geocodes).to_numpy(dtype=float) for column in columns]
+
+    frames = [(values[0], str(years[0]))]
+    for i in range(1, len(values)):
+        for step in range(1, steps + 1):
+            t = step / (steps + 1)
+            frames.append(((1 - t) * values[i - 1] + t * values[i], f"{years[i - 1]}→{years[i]} (interpolated)"))
+        # Census years are shown as they are, so a value missing from the year before does not hide them
+        frames.append((values[i], str(years[i])))
+
+    return frames
+
+
+def export_animation(strings, census_data, filename, type="Census Subdivisions", clipped=False, steps=0,
+                     frame_duration=1000, processes=None):
+    """
+    Exports an animation of a characteristic over multiple census years
+    :param strings: A tuple of the characteristic names or derived metrics to be plotted, one per census
+    :param census_data: A list of census objects
+    :param filename: The file to save the animation to, either a .gif or a .mp4
+    :param type: The type of geography to be displayed: "Census Subdivisions", "Census Divisions", or "Provinces"
+    :param clipped: Whether or not data with the outliers clipped should be displayed
+    :param steps: The number of interpolated frames to add between each pair of years
+    :param frame_duration: The time each census year is shown for in milliseconds. Interpolated frames share this time
+    :param processes: The number of processes used to render frames. Defaults to the number of cpus
+    :return: None
+    """
+    geo_level = map_plot.get_property_names(type)[0]
+    cad, _, _, stats = map_plot.build_cad(None, strings, census_data, None, type)
+
+    columns = [str(cen.year) for cen in census_data]
+    if clipped:
+        columns = [map_plot.clip_df_column(column, cad, stats) for column in columns]
+
+    paths_filename = get_paths(type)
+    with open(paths_filename, "rb") as file:
+        geocodes = pickle.load(file)["geocodes"]
+
+    frames = get_frames(cad, geo_level, geocodes, columns, [cen.year for cen in census_data], steps)
+    thresholds = map_plot.det_thresholds(cad, columns, stats)
+    legend_name = str(strings[0])
+
+    frame_dir = filename + " frames"
+    os.makedirs(frame_dir, exist_ok=True)
+
+    try:
+        with ProcessPoolExecutor(processes, initializer=_init_renderer,
+                                 initargs=(paths_filename, thresholds, legend_name)) as executor:
+            frame_files = list(executor.map(_render_frame, [values for values, _ in frames],
+                                            [label for _, label in frames],
+                                            [os.path.join(frame_dir, f"{i:04d}.png") for i in range(len(frames))]))
+
+        assemble(frame_files, filename, frame_duration / (steps + 1))
+    finally:
+        shutil.rmtree(frame_dir)
+
+
+def assemble(frame_files, filename, duration):
+    """
+    Assembles frames into an animation
+    :param frame_files: A list of the png files of each frame, in order
+    :param filename: The file to save the animation to, either a .gif or a .mp4
+    :param duration: The time each frame is shown for in milliseconds
+    :return: None
+    """
+    if filename.lower().endswith(".gif"):
+        images = [Image.open(frame_file).convert("RGB") for frame_file in frame_files]
+        images[0].save(filename, save_all=True, append_images=images[1:], duration=duration, loop=0)
+    elif filename.lower().endswith(".mp4"):
+        # Writing videos requires imageio with its ffmpeg plugin, which is only needed for this format
+        import imageio
+        with imageio.get_writer(filename, fps=1000 / duration) as writer:
+            for frame_file in frame_files:
+                writer.append_data(imageio.imread(frame_file))
+    else:
+        raise ValueError("Animations must be saved as a .gif or a .mp4")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export an animation of census data over multiple years")
+    parser.add_argument("--years", type=int, nargs="+", required=True, help="The census years to animate")
+    parser.add_argument("--characteristic", action="append",
+                        help="A characteristic name or [path] for each year")
+    parser.add_argument("--metric", help="A derived metric expression to animate instead of characteristics")
+    parser.add_argument("--geography", default=constants.GEOGRAPHIES[0], choices=constants.GEOGRAPHIES)
+    parser.add_argument("--clipped", action="store_true", help="Clip outliers from the data")
+    parser.add_argument("--steps", type=int, default=0, help="Interpolated frames to add between census years")
+    parser.add_argument("--duration", type=int, default=1000, help="Milliseconds each census year is shown for")
+    parser.add_argument("--output", default="animation.gif", help="The .gif or .mp4 file to save")
+    parser.add_argument("--processes", type=int, help="The number of processes used to render frames")
+    args = parser.parse_args()
+
+    main.process_data()
+    main.load_data()
+
+    cen = census.get_censuses(args.years)
+    if args.metric is not None:
+        strings = [metrics.Metric(args.metric)] * len(cen)
+    elif args.characteristic is not None and len(args.characteristic) == len(cen):
+        strings = args.characteristic
+    else:
+        parser.error("A characteristic must be given for every year, or a metric given instead")
+
+    export_animation(strings, cen, args.output, args.geography, args.clipped, args.steps, args.duration,
+                     args.processes)
@@ -0,0 +1,235 @@
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import re
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from anytree import PreOrderIter
+import census
+import constants
+import dataset
+import main
+import map_plot
+import metrics
+
+# Creates maps without the user interface. Jobs are given by a json file of the form:
+# {"jobs": [{"years": [2016, 2021], "characteristics": ["Population, 2016", "Population, 2021"],
+#            "geography": ["Provinces", "Census Divisions"], "method": "Mean Percent Change", "clipped": [true, false]}]}
+# Characteristics are names or paths within square brackets (see dataset.resolve_path), given once per year. They may
+# instead be "all leaves" to map every leaf characteristic whose path exists in every year, or a "metric" expression
+# may be given in their place (see metrics.Metric). Geography, method and clipped may each be a value or a list, and a
+# map is created for every combination.
+ALL_LEAVES = "all leaves"
+_LOG_FILENAME = "batch_log.jsonl"
+_MAX_SLUG_LENGTH = 60
+_HASH_LENGTH = 10
+
+
+def load_jobs(spec):
+    """
+    Expands a job specification into individual map jobs
+    :param spec: A dictionary of the form described at the top of this module
+    :return: A list of dictionaries, each describing a single map
+    """
+    jobs = []
+
+    for item in spec["jobs"]:
+        years = [int(year) for year in item["years"]]
+        cen = census.get_censuses(years)
+
+        if "metric" in item:
+            characteristic_sets = [{"metric": item["metric"]}]
+        elif item["characteristics"] == ALL_LEAVES:
+            characteristic_sets = [{"characteristics": ["[" + path + "]"] * len(years)}
+                                   for path in get_leaf_paths(cen)]
+        elif len(item["characteristics"]) == len(years):
+            characteristic_sets = [{"characteristics": list(item["characteristics"])}]
+        else:
+            raise ValueError("A characteristic must be given for every year of a job")
+
+        # The processing method only matters when multiple years are mapped
+        methods = _as_list(item.get("method", constants.FUNC_NAMES[0])) if len(years) > 1 else [None]
+
+        for characteristics, geography, method, clipped in itertools.product(
+                characteristic_sets, _as_list(item.get("geography", constants.GEOGRAPHIES[0])), methods,
+                _as_list(item.get("clipped", False))):
+            job = {"years": years, "geography": geography, "method": method, "clipped": bool(clipped)}
+            job.update(characteristics)
+            job["id"] = get_job_id(job)
+            jobs.append(job)
+
+    return jobs
+
+
+def _as_list(value):
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def get_leaf_paths(census_data):
+    """
+    Gets the paths of the leaf characteristics that exist exactly once within the characteristic trees of every census
+    :param census_data: A list of census objects
+    :return: A list of paths, in the order of the characteristic tree of the first census
+    """
+    paths = None
+    for cen in census_data:
+        counts = Counter(dataset.get_path(node) for node in PreOrderIter(cen.char_tree)
+                         if node.is_leaf and node is not cen.char_tree)
+        # Paths that are not unique within any census can not be resolved
+        if paths is None:
+            paths = [path for path in counts if counts[path] == 1]
+        else:
+            paths = [path for path in paths if counts[path] == 1]
+
+    return paths
+
+
+def get_job_id(job):
+    """
+    Gets a unique and readable identifier for a job, used to name its output
+    :param job: A dictionary describing a single map
+    :return: A string that is safe to use within a filename
+    """
+    description = job.get("metric") or job["characteristics"][0].strip("[]").split(dataset.PATH_SEPARATOR)[-1]
+    slug = re.sub(r"[^A-Za-z0-9]+", "-", description).strip("-")[:_MAX_SLUG_LENGTH]
+    digest = hashlib.sha256(json.dumps(job, sort_keys=True).encode()).hexdigest()[:_HASH_LENGTH]
+    return f"{'-'.join(str(year) for year in job['years'])}_{slug}_{digest}"
+
+
+def run_job(job, output_dir):
+    """
+    Creates and saves the map of a job
+    :param job: A dictionary describing a single map
+    :param output_dir: The directory the map is saved within
+    :return: A dictionary describing the outcome of the job
+    """
+    start_time = time.time()
+    filename = os.path.join(output_dir, job["id"] + ".html")
+
+    try:
+        cen = census.get_censuses(job["years"])
+
+        if "metric" in job:
+            strings = [metrics.Metric(job["metric"])] * len(cen)
+        else:
+            strings = job["characteristics"]
+
+        func = None if job["method"] is None else map_plot.FUNC_LIST[constants.FUNC_NAMES.index(job["method"])]
+        m = map_plot.build_map(job["method"], strings, cen, func, job["geography"], job["clipped"])
+
+        # Save to a temporary file first so that an interrupted job never leaves a partial map behind
+        map_plot.output_map(m, filename + ".tmp", open_browser=False)
+        os.replace(filename + ".tmp", filename)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+
+    return {"id": job["id"], "file": filename, "seconds": round(time.time() - start_time, 3), "error": error}
+
+
+def get_completed(output_dir):
+    """
+    Gets the jobs that have already been completed within an output directory
+    :param output_dir: The directory of a batch
+    :return: A set of the ids of completed jobs
+    """
+    completed = set()
+    log_filename = os.path.join(output_dir, _LOG_FILENAME)
+
+    if os.path.isfile(log_filename):
+        with open(log_filename, "r") as file:
+            for line in file:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be partial if the batch was interrupted
+                    continue
+                if result["error"] is None and os.path.isfile(result["file"]):
+                    completed.add(result["id"])
+
+    return completed
+
+
+def run_batch(jobs, output_dir, processes=None, memory_map=False):
+    """
+    Runs jobs over a pool of processes, skipping jobs that were completed by a previous run. The outcome of every job is
+    appended to a log within the output directory as it completes.
+    :param jobs: A list of dictionaries, each describing a single map
+    :param output_dir: The directory maps are saved within
+    :param processes: The number of processes to use. Defaults to the number of cpus
+    :param memory_map: Should census data be memory-mapped? This allows the processes to share a single copy
+    :return: A list of the outcomes of the jobs that were run
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    completed = get_completed(output_dir)
+    remaining = [job for job in jobs if job["id"] not in completed]
+    print(f"{len(jobs) - len(remaining)} of {len(jobs)} jobs already completed")
+
+    # Where possible, workers are forked so that they share the data loaded by this process
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+
+    results = []
+    with open(os.path.join(output_dir, _LOG_FILENAME), "a") as log, \
+            ProcessPoolExecutor(processes, context, main.init_worker, (memory_map,)) as executor:
+        futures = [executor.submit(run_job, job, output_dir) for job in remaining]
+
+        for count, future in enumerate(as_completed(futures), 1):
+            result = future.result()
+            results.append(result)
+            log.write(json.dumps(result) + "\n")
+            log.flush()
+
+            status = "done" if result["error"] is None else "FAILED"
+            print(f"Job {count} of {len(remaining)} {status} in {result['seconds']} seconds: {result['id']}")
+
+    failures = [result for result in results if result["error"] is not None]
+    for result in failures:
+        print(f"Job {result['id']} failed:\n{result['error']}")
+    print(f"Batch complete: {len(results) - len(failures)} succeeded, {len(failures)} failed")
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create census maps without the user interface")
+    parser.add_argument("--spec", help="A json file of jobs, see batch.py for its format")
+    parser.add_argument("--years", type=int, nargs="+", help="The census years of a single job")
+    parser.add_argument("--characteristic", action="append",
+                        help="A characteristic name or [path] for each year, or 'all leaves'")
+    parser.add_argument("--metric", help="A derived metric expression to map instead of characteristics")
+    parser.add_argument("--geography", nargs="+", default=[constants.GEOGRAPHIES[0]], choices=constants.GEOGRAPHIES)
+    parser.add_argument("--method", nargs="+", default=[constants.FUNC_NAMES[0]], choices=constants.FUNC_NAMES)
+    parser.add_argument("--clipped", action="store_true", help="Clip outliers from the data")
+    parser.add_argument("--output", default="batch_output", help="The directory maps are saved within")
+    parser.add_argument("--processes", type=int, help="The number of processes to use")
+    parser.add_argument("--memory-map", action="store_true", help="Memory-map census data from arrow files")
+    args = parser.parse_args()
+
+    if args.spec is not None:
+        with open(args.spec, "r") as file:
+            job_spec = json.load(file)
+    elif args.years is not None:
+        item = {"years": args.years, "geography": args.geography, "method": args.method, "clipped": args.clipped}
+        if args.metric is not None:
+            item["metric"] = args.metric
+        elif args.characteristic == [ALL_LEAVES]:
+            item["characteristics"] = ALL_LEAVES
+        elif args.characteristic is not None and len(args.characteristic) == len(args.years):
+            item["characteristics"] = args.characteristic
+        else:
+            parser.error(f"A characteristic must be given for every year, '{ALL_LEAVES}' given, or a metric given")
+        job_spec = {"jobs": [item]}
+    else:
+        parser.error("Either --spec or --years must be given")
+
+    main.process_data(memory_map=args.memory_map)
+    main.load_data(args.memory_map)
+
+    run_batch(load_jobs(job_spec), args.output, args.processes, args.memory_map)
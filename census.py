@@ -5,19 +5,24 @@
 class Census:
     def __init__(self, year, url, filename_keep, filename_csv, filename_par, leading_spaces, characteristic_col,
                  geo_col, total_col,
-                 geocode_col, delete_first_line=False):
+                 geocode_col, delete_first_line=False, filename_tree=None,
+                 filename_arrow=None, symbol_col=None):
         """
         :param year: The year of the census
         :param url: The download url
         :param filename_keep: The file to keep from the downloaded zip file
         :param filename_csv: The csv filename
-        :param filename_par: The parquet filename
+        :param filename_par: The directory of the partitioned parquet dataset
         :param leading_spaces: The number of spaces used to indent each characteristic within the characteristic tree
         :param characteristic_col: The name of the column used to hold the characteristic type
         :param geo_col: The column used to hold the value "Alberta"
         :param total_col: The name of the column used to hold the data total
         :param geocode_col: The name of the column that holds the CSDUID
         :param delete_first_line: Whether the first line of the csv should be deleted
+        :param filename_tree: The pickle filename for the characteristic tree. Defaults to one named after the year
+        :param filename_arrow: The arrow IPC filename used to memory-map the data. Defaults to one named after the year
+        :param symbol_col: The name of the column holding the symbol that explains a missing total. If None, symbols
+        are held within the total column
         """
         self.year = year
         self.url = url
@@ -32,6 +37,9 @@ class Census:
         self.data_df = None
         self.char_tree = None
         self.delete_first_line = delete_first_line
+        self.filename_tree = filename_tree if filename_tree is not None else f"{year}CharacteristicTree.pickle"
+        self.filename_arrow = filename_arrow if filename_arrow is not None else f"{year}CensusData.arrow"
+        self.symbol_col = symbol_col
 
     def set_data_df(self, data_df):
         self.data_df = data_df
@@ -39,12 +47,20 @@ class Census:
     def set_char_tree(self, char_tree):
         self.char_tree = char_tree
 
+    def get_config(self, *attributes):
+        """
+        Gets the configuration of the census, used to detect when processed data is stale
+        :param attributes: The names of the attributes to include
+        :return: A dictionary of the attribute names and their values
+        """
+        return {attribute: getattr(self, attribute) for attribute in attributes}
+
 
 censuses = [Census(2011,
                    "https://www12.statcan.gc.ca/census-recensement/2011/dp-pd/prof/details/download-telecharger/comprehensive/comp_download.cfm?CTLG=98-316-XWE2011001&FMT=CSV301&Lang=E&Tab=1&Geo1=PR&Code1=01&Geo2=PR&Code2=01&Data=Count&SearchText=&SearchType=Begins&SearchPR=01&B1=All&Custom=&TABID=1",
                    "98-316-XWE2011001-301.CSV", "2011CensusData.CSV", "2011CensusData.parquet", 3, "Characteristics",
                    "Prov_Name", "Total",
-                   "Geo_Code", delete_first_line=True),
+                   "Geo_Code", delete_first_line=True, symbol_col="Flag_Total"),
             Census(2016,
                    "https://www12.statcan.gc.ca/census-recensement/2016/dp-pd/prof/details/download-telecharger/comp/GetFile.cfm?Lang=E&FILETYPE=CSV&GEONO=055",
                    "98-401-X2016055_English_CSV_data.csv", "2016CensusData.CSV", "2016CensusData.parquet", 2,
@@ -54,4 +70,17 @@ censuses = [Census(2011,
                    "https://www12.statcan.gc.ca/census-recensement/2021/dp-pd/prof/details/download-telecharger/comp/GetFile.cfm?Lang=E&FILETYPE=CSV&GEONO=005",
                    "98-401-X2021005_English_CSV_data.csv", "2021CensusData.CSV", "2021CensusData.parquet", 2,
                    "CHARACTERISTIC_NAME", "GEO_NAME",
-                   "C1_COUNT_TOTAL", "ALT_GEO_CODE")]
+                   "C1_COUNT_TOTAL", "ALT_GEO_CODE", symbol_col="SYMBOL")]
+
+
+def get_censuses(years):
+    """
+    Gets the censuses for a list of years
+    :param years: A list of census years
+    :return: A list of census objects, in the same order as the years
+    """
+    by_year = {cen.year: cen for cen in censuses}
+    missing = [year for year in years if year not in by_year]
+    if missing:
+        raise ValueError(f"No census exists for the years {missing}")
+    return [by_year[year] for year in years]
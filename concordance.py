@@ -0,0 +1,248 @@
+import argparse
+import os
+import pickle
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from scipy import sparse
+import constants
+import dataset
+import metrics
+import map_plot
+import simplify
+from manifest import Manifest
+
+# Maps the data of older censuses onto the geographies of the 2021 census, which every map is drawn with. Geographies
+# that were merged, split, or renumbered between censuses are matched by overlaying the boundaries of each census with
+# the 2021 boundaries, and values are interpolated by the area the geographies share.
+# Source for boundary files: https://www12.statcan.gc.ca/census-recensement/alternative_alternatif.cfm?l=eng&dispext=zip&teng=lcsd000b16a_e.zip
+TARGET_YEAR = 2021
+# Provinces have not changed between censuses, so they are matched by geocode alone
+BOUNDARY_FILENAMES = {2011: {"Census Subdivisions": "mapData/raw/gcsd000b11a_e.shp",
+                             "Census Divisions": "mapData/raw/gcd_000b11a_e.shp"},
+                      2016: {"Census Subdivisions": "mapData/raw/lcsd000b16a_e.shp",
+                             "Census Divisions": "mapData/raw/lcd_000b16a_e.shp"}}
+# Canada Albers Equal Area Conic, so that areas are comparable across the country
+_CRS = "ESRI:102001"
+# Overlaps smaller than this share of either geography are slivers caused by boundaries being drawn differently
+_MIN_SHARE = 1e-3
+# Characteristics with labels matching this are averages, medians, or ratios, which are interpolated as area weighted
+# means rather than apportioned like counts
+_INTENSIVE_PATTERN = re.compile(r"\b(median|average|mean|percent|percentage|rate|ratio|per)\b|%", re.IGNORECASE)
+# The source of the data that ends many labels, such as " - 100% data" or " - 25% sample data"
+_SOURCE_PATTERN = re.compile(r"\s+-\s+\d+% (sample )?data\s*$", re.IGNORECASE)
+_PATH_PATTERN = re.compile(r"\[[^\]]*\]")
+
+_concordance_cache = {}
+
+
+class Concordance:
+    """
+    The areas shared by the geographies of an older census and the geographies of the 2021 census
+    """
+
+    def __init__(self, old_geocodes, new_geocodes, areas):
+        """
+        :param old_geocodes: An array of the geocodes of the older census
+        :param new_geocodes: An array of the geocodes of the 2021 census
+        :param areas: A sparse matrix of the area shared by each 2021 geography (rows) and older geography (columns)
+        """
+        self.old_geocodes = old_geocodes
+        self.new_geocodes = new_geocodes
+        self.areas = areas.tocsr()
+
+        # Counts are apportioned by the share of each older geography that lies within each 2021 geography
+        old_areas = np.asarray(self.areas.sum(axis=0)).ravel()
+        self._shares = (self.areas @ sparse.diags(np.divide(1, old_areas, out=np.zeros_like(old_areas),
+                                                            where=old_areas > 0))).tocsr()
+        # The 2021 geographies that overlap any older geography
+        self.covered = np.diff(self.areas.indptr) > 0
+        # The older geography covering the most of each 2021 geography, which data quality flags are carried from
+        self._dominant = np.asarray(self.areas.argmax(axis=1)).ravel()
+
+    def reproject(self, values, intensive):
+        """
+        Interpolates values of the older geographies onto the 2021 geographies
+        :param values: An array of the values of the older geographies, either a vector or a matrix with a column for
+        each characteristic
+        :param intensive: Whether the values are averages or ratios rather than counts, either for all values or as an
+        array with an entry for each column
+        :return: An array of the values of the 2021 geographies. Values are NaN where they can not be determined
+        """
+        values = np.asarray(values, dtype=float)
+        missing = np.isnan(values)
+        filled = np.where(missing, 0, values)
+
+        # Counts are unknown if any part of them would come from a geography without data
+        extensive = self._shares @ filled
+        extensive[(self._shares @ missing.astype(float)) > 0] = np.nan
+
+        # Averages are taken over the parts of a geography that have data
+        with np.errstate(divide="ignore", invalid="ignore"):
+            intensive_values = (self.areas @ filled) / (self.areas @ (~missing).astype(float))
+
+        result = np.where(intensive, intensive_values, extensive)
+        result[~self.covered] = np.nan
+        return result
+
+    def reproject_flags(self, flags):
+        """
+        Carries the data quality flags of the older geographies onto the 2021 geographies
+        :param flags: An array of flags of the older geographies, either a vector or a matrix with a column for each
+        characteristic
+        :return: An array of the flag of the older geography covering the most of each 2021 geography
+        """
+        flags = np.asarray(flags, dtype=object)[self._dominant]
+        flags[~self.covered] = None
+        return np.where(pd.isna(flags), None, flags)
+
+    def reproject_df(self, data_df, cen, intensive):
+        """
+        Interpolates the rows of a characteristic onto the 2021 geographies
+        :param data_df: A dataframe of the rows of a single characteristic, in the form returned by dataset.read_values
+        :param cen: The census the rows were read from
+        :param intensive: Whether the values are averages or ratios rather than counts
+        :return: A dataframe in the same form, with a row for each 2021 geography that overlaps an older geography
+        """
+        name = data_df[cen.characteristic_col].iloc[0] if len(data_df) else None
+
+        data_df = data_df.drop_duplicates(cen.geocode_col).set_index(cen.geocode_col)
+        data_df.index = data_df.index.astype(str)
+        data_df = data_df.reindex(self.old_geocodes)
+
+        data_df = pd.DataFrame({cen.geocode_col: self.new_geocodes,
+                                cen.characteristic_col: name,
+                                dataset.VALUE_COL: self.reproject(data_df[dataset.VALUE_COL].to_numpy(
+                                    dtype=float, na_value=np.nan), intensive),
+                                dataset.FLAG_COL: self.reproject_flags(data_df[dataset.FLAG_COL].to_numpy())})
+        return data_df[self.covered]
+
+
+def is_intensive(characteristic):
+    """
+    Determines whether a characteristic is an average or a ratio, rather than a count. Only the label of the
+    characteristic itself is considered, not the labels of its ancestors.
+    :param characteristic: A node of a characteristic tree, or a derived metric
+    :return: True if the characteristic is an average or a ratio
+    """
+    if isinstance(characteristic, metrics.Metric):
+        # A derived metric is a ratio if it divides outside of the paths it refers to
+        return ("/" in _PATH_PATTERN.sub("", characteristic.expression) or
+                _INTENSIVE_PATTERN.search(_PATH_PATTERN.sub("", characteristic.name)) is not None)
+
+    label = _SOURCE_PATTERN.sub("", dataset.get_label(characteristic))
+    return _INTENSIVE_PATTERN.search(label) is not None
+
+
+def get_filename(year, type):
+    """
+    Gets the filename of a cached concordance
+    :param year: The year of the older census
+    :param type: A string representing the type of geography: "Census Subdivisions" or "Census Divisions"
+    :return: The filename as a string
+    """
+    return os.path.join(constants.CACHE_DIR, f"{type} {year} concordance.pickle")
+
+
+def build_concordance(year, type):
+    """
+    Overlays the boundaries of an older census with the 2021 boundaries and saves the area shared by each pair of
+    geographies
+    :param year: The year of the older census
+    :param type: A string representing the type of geography: "Census Subdivisions" or "Census Divisions"
+    :return: The filename of the concordance
+    """
+    geo_level = map_plot.get_property_names(type)[0]
+    old = gpd.read_file(BOUNDARY_FILENAMES[year][type]).to_crs(_CRS)
+    new = gpd.read_file(simplify.RAW_FILENAMES[type]).to_crs(_CRS)
+    old_geometries = shapely.make_valid(old.geometry.to_numpy())
+    new_geometries = shapely.make_valid(new.geometry.to_numpy())
+
+    old_indices, new_indices = shapely.STRtree(new_geometries).query(old_geometries, predicate="intersects")
+    shared = shapely.area(shapely.intersection(old_geometries[old_indices], new_geometries[new_indices]))
+
+    # Discard slivers, which would otherwise link geographies that only touch
+    smaller = np.minimum(shapely.area(old_geometries)[old_indices], shapely.area(new_geometries)[new_indices])
+    keep = shared >= _MIN_SHARE * smaller
+
+    areas = sparse.csr_matrix((shared[keep], (new_indices[keep], old_indices[keep])),
+                              shape=(len(new_geometries), len(old_geometries)))
+
+    filename = get_filename(year, type)
+    os.makedirs(constants.CACHE_DIR, exist_ok=True)
+    with open(filename, "wb") as file:
+        pickle.dump({"old_geocodes": old[geo_level].astype(str).to_numpy(dtype=object),
+                     "new_geocodes": new[geo_level].astype(str).to_numpy(dtype=object),
+                     "areas": areas}, file)
+    return filename
+
+
+def build_concordances(processes=None):
+    """
+    Builds the concordance of every older census and geography in parallel. Concordances are recorded within the
+    manifest, so they are only rebuilt when a boundary file changes. Boundary files that have not been downloaded are
+    skipped, and the data of those censuses is matched by geocode alone.
+    :param processes: The number of processes to use. Defaults to the number of cpus
+    :return: None
+    """
+    manifest = Manifest()
+    stale = {}
+
+    for year, filenames in BOUNDARY_FILENAMES.items():
+        for type, filename in filenames.items():
+            if not os.path.isfile(filename) or not os.path.isfile(simplify.RAW_FILENAMES[type]):
+                continue
+
+            inputs = {"boundaries": manifest.fingerprint(filename),
+                      "target": manifest.fingerprint(simplify.RAW_FILENAMES[type]),
+                      "crs": _CRS, "min share": _MIN_SHARE}
+            if not manifest.is_current("concordance", f"{type} {year}", inputs, [get_filename(year, type)]):
+                stale[(year, type)] = inputs
+
+    if not stale:
+        return
+
+    with ProcessPoolExecutor(processes) as executor:
+        futures = {executor.submit(build_concordance, year, type): (year, type) for year, type in stale}
+
+        for future in as_completed(futures):
+            year, type = futures[future]
+            manifest.record("concordance", f"{type} {year}", stale[(year, type)], [future.result()])
+            print(f"Built the concordance of {type} from {year} to {TARGET_YEAR}")
+
+
+def get_concordance(year, type):
+    """
+    Gets the concordance used to map the data of a census onto the 2021 geographies. Concordances are cached until
+    their file changes.
+    :param year: The year of the census
+    :param type: A string representing the type of geography: "Census Subdivisions", "Census Divisions", or "Provinces"
+    :return: A Concordance, or None if the data of the census is matched by geocode
+    """
+    if type not in BOUNDARY_FILENAMES.get(year, {}):
+        return None
+
+    filename = get_filename(year, type)
+    if not os.path.isfile(filename):
+        return None
+
+    mtime = os.stat(filename).st_mtime_ns
+    cached = _concordance_cache.get(filename)
+    if cached is None or cached[0] != mtime:
+        with open(filename, "rb") as file:
+            data = pickle.load(file)
+        cached = (mtime, Concordance(data["old_geocodes"], data["new_geocodes"], data["areas"]))
+        _concordance_cache[filename] = cached
+
+    return cached[1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Match the geographies of older censuses to the 2021 geographies")
+    parser.add_argument("--processes", type=int, help="The number of processes to use")
+    args = parser.parse_args()
+
+    build_concordances(args.processes)
@@ -0,0 +1,10 @@
+# Constants shared by several modules. This module imports nothing, so it can be imported from anywhere without
+# creating an import cycle.
+
+# Separates the numbering of a characteristic from its name within the nodes of a characteristic tree
+TREE_SEPARATOR = "⤚"
+# The names of the functions that operate on data from multiple years, in the order of map_plot.FUNC_LIST
+FUNC_NAMES = ("Mean Difference", "Mean Percent Change", "Mean Percent Difference")
+GEOGRAPHIES = ("Census Subdivisions", "Census Divisions", "Provinces")
+# Files derived from the boundary files, which are rebuilt whenever a boundary file changes
+CACHE_DIR = "mapData/cache"
@@ -0,0 +1,292 @@
+import argparse
+import itertools
+import json
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import batch
+import census
+import constants
+import concordance
+import dataset
+import main
+import map_plot
+import metrics
+from manifest import Manifest
+
+# Precomputes the data of every leaf characteristic, for every geography and combination of census years, along with
+# the result of every function in map_plot.FUNC_LIST. Results are stored in parquet files that are sorted by
+# characteristic path, along with an index of the statistics of each column, so that a plot can be served by a lookup.
+CUBE_DIR = "cube"
+_INDEX_FILENAME = os.path.join(CUBE_DIR, "index.parquet")
+# Leaves are split into tasks of this size, so that the build is spread evenly over processes
+_LEAVES_PER_TASK = 200
+_ROWS_PER_GROUP = 20000
+PATH_COL = "path"
+GEOCODE_COL = "geocode"
+FLAG_SUFFIX = " flag"
+_STAT_COLUMNS = ["q1", "q3", "min", "max"]
+
+_index_cache = {}
+
+
+def get_year_combinations():
+    """
+    Gets every combination of census years, in chronological order
+    :return: A list of tuples of years
+    """
+    years = sorted(cen.year for cen in census.censuses)
+    return [combination for r in range(1, len(years) + 1) for combination in itertools.combinations(years, r)]
+
+
+def get_tasks():
+    """
+    Splits the build of the cube into tasks
+    :return: A list of dictionaries, each describing a task
+    """
+    tasks = []
+    for type in constants.GEOGRAPHIES:
+        for years in get_year_combinations():
+            paths = batch.get_leaf_paths(census.get_censuses(years))
+            for start in range(0, len(paths), _LEAVES_PER_TASK):
+                name = f"{type}/{'-'.join(str(year) for year in years)}/{start // _LEAVES_PER_TASK:04d}"
+                tasks.append({"id": name, "type": type, "years": list(years),
+                              "paths": paths[start:start + _LEAVES_PER_TASK],
+                              "file": os.path.join(CUBE_DIR, name + ".parquet")})
+    return tasks
+
+
+def _get_source(manifest, years, type):
+    """
+    Gets the hashes of the census data that the cube is built from, used to detect a stale cube
+    :param manifest: The build manifest
+    :param years: The census years
+    :param type: The type of geography
+    :return: A dictionary of the hashes of the data, characteristic tree, and concordance of each year
+    """
+    source = {}
+    for cen in census.get_censuses(years):
+        source[str(cen.year)] = [manifest.get_outputs(cen.year, "parquet").get(cen.filename_par),
+                                 manifest.get_outputs(cen.year, "tree").get(cen.filename_tree),
+                                 manifest.get_outputs("concordance", f"{type} {cen.year}").get(
+                                     concordance.get_filename(cen.year, type))]
+    return source
+
+
+def read_matrix(cen, nodes, geocodes, type):
+    """
+    Reads the values and flags of characteristics as matrices of geographies by characteristics. As within
+    map_plot.build_cad, older censuses are interpolated onto the geographies of the boundary file.
+    :param cen: The census to read from
+    :param nodes: A list of nodes of the characteristic tree of the census, one per column
+    :param geocodes: An array of the geocodes of the boundary file, one per row
+    :param type: The type of geography
+    :return: A matrix of values, a matrix of flags, and an array of whether each geography has data
+    """
+    conc = concordance.get_concordance(cen.year, type)
+    source_geocodes = geocodes if conc is None else conc.old_geocodes
+
+    char_indices = dataset.get_char_indices(cen.char_tree)
+    data_df = dataset.read_values(cen, nodes, source_geocodes,
+                                  [cen.geocode_col, dataset.CHAR_INDEX_COL, dataset.VALUE_COL, dataset.FLAG_COL])
+    data_df = data_df.drop_duplicates([cen.geocode_col, dataset.CHAR_INDEX_COL]).set_index(
+        [cen.geocode_col, dataset.CHAR_INDEX_COL])
+
+    columns = [char_indices[node] for node in nodes]
+    values = data_df[dataset.VALUE_COL].astype(float).unstack().reindex(
+        index=source_geocodes, columns=columns).to_numpy(dtype=float)
+    flags = data_df[dataset.FLAG_COL].astype(object).unstack().reindex(
+        index=source_geocodes, columns=columns).to_numpy(dtype=object)
+
+    if conc is None:
+        return values, flags, np.isin(geocodes, data_df.index.get_level_values(0).astype(str))
+
+    # Every characteristic is interpolated with a single sparse matrix product
+    intensive = np.array([concordance.is_intensive(node) for node in nodes])
+    values = pd.DataFrame(conc.reproject(values, intensive), index=conc.new_geocodes).reindex(geocodes)
+    flags = pd.DataFrame(conc.reproject_flags(flags), index=conc.new_geocodes).reindex(geocodes)
+    return (values.to_numpy(dtype=float), flags.to_numpy(dtype=object),
+            np.isin(geocodes, conc.new_geocodes[conc.covered]))
+
+
+def build_task(task):
+    """
+    Computes the data, function data and statistics of a task and saves them to parquet files
+    :param task: A dictionary describing the task, see get_tasks
+    :return: The task
+    """
+    cen = census.get_censuses(task["years"])
+    geo_level = map_plot.get_property_names(task["type"])[0]
+    geocodes = map_plot.get_cad_file(task["type"])[geo_level].astype(str).to_numpy()
+
+    values = []
+    flags = []
+    matched = np.ones(len(geocodes), dtype=bool)
+
+    for census_data in cen:
+        nodes = [dataset.resolve_path(census_data.char_tree, path) for path in task["paths"]]
+        year_values, year_flags, present = read_matrix(census_data, nodes, geocodes, task["type"])
+        values.append(year_values)
+        flags.append(year_flags)
+        matched &= present
+
+    # As within map_plot.proc_columns, only geographies with data in every year are given values
+    columns = {}
+    for i, census_data in enumerate(cen):
+        columns[str(census_data.year)] = np.where(matched[:, None], values[i], 0)
+        columns[str(census_data.year) + FLAG_SUFFIX] = flags[i]
+    if len(cen) > 1:
+        for name, func in zip(constants.FUNC_NAMES, map_plot.FUNC_LIST):
+            columns[name] = np.where(matched[:, None], func(np.stack(values)), 0)
+
+    # Rows are ordered by characteristic and then geography, so that a lookup only reads the row groups it needs
+    n_geo, n_paths = len(geocodes), len(task["paths"])
+    table = {PATH_COL: pa.array(np.repeat(task["paths"], n_geo)).dictionary_encode(),
+             GEOCODE_COL: pa.array(np.tile(geocodes, n_paths)).dictionary_encode()}
+    for name, column in columns.items():
+        if name.endswith(FLAG_SUFFIX):
+            column = column.T.ravel()
+            table[name] = pa.array(np.where(pd.isna(column), None, column), pa.string()).dictionary_encode()
+        else:
+            table[name] = pa.array(column.T.ravel(), pa.float64())
+
+    # Statistics used to clip outliers and to determine thresholds
+    stats = []
+    with warnings.catch_warnings():
+        # Characteristics without any data give NaN statistics
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for name, column in columns.items():
+            if name.endswith(FLAG_SUFFIX):
+                continue
+            q1, q3 = np.nanquantile(column, [0.25, 0.75], axis=0)
+            stats.append(pd.DataFrame({PATH_COL: task["paths"], "column": name, "q1": q1, "q3": q3,
+                                       "min": np.nanmin(column, axis=0), "max": np.nanmax(column, axis=0)}))
+    stats = pd.concat(stats)
+    stats["type"] = task["type"]
+    stats["years"] = "-".join(str(year) for year in task["years"])
+    stats["file"] = task["file"]
+
+    os.makedirs(os.path.dirname(task["file"]), exist_ok=True)
+    pq.write_table(pa.table(table), task["file"] + ".tmp", row_group_size=_ROWS_PER_GROUP, compression="zstd")
+    os.replace(task["file"] + ".tmp", task["file"])
+    stats.to_parquet(_get_stats_filename(task) + ".tmp", index=False)
+    os.replace(_get_stats_filename(task) + ".tmp", _get_stats_filename(task))
+
+    return task
+
+
+def _get_stats_filename(task):
+    return task["file"].replace(".parquet", ".stats.parquet")
+
+
+def build_cube(processes=None):
+    """
+    Builds every task of the cube over a pool of processes and then writes the index. Completed tasks are recorded
+    within the manifest, so an interrupted build resumes where it stopped and only stale tasks are rebuilt.
+    :param processes: The number of processes to use. Defaults to the number of cpus
+    :return: None
+    """
+    manifest = Manifest()
+    tasks = get_tasks()
+    stale = {}
+
+    for task in tasks:
+        inputs = {"source": _get_source(manifest, task["years"], task["type"]), "paths": task["paths"],
+                  "boundaries": map_plot.get_cad_filename(task["type"]), "functions": list(constants.FUNC_NAMES)}
+        if not manifest.is_current("cube", task["id"], inputs, [task["file"], _get_stats_filename(task)]):
+            stale[task["id"]] = inputs
+
+    print(f"{len(tasks) - len(stale)} of {len(tasks)} cube tasks already completed")
+
+    # Tasks are independent, so the build scales with the number of processes
+    with ProcessPoolExecutor(processes, initializer=main.init_worker) as executor:
+        futures = [executor.submit(build_task, task) for task in tasks if task["id"] in stale]
+
+        for count, future in enumerate(as_completed(futures), 1):
+            task = future.result()
+            manifest.record("cube", task["id"], stale[task["id"]], [task["file"], _get_stats_filename(task)])
+            print(f"Completed cube task {count} of {len(futures)}: {task['id']}")
+
+    index = pd.concat([pd.read_parquet(_get_stats_filename(task)) for task in tasks])
+    index["source"] = [json.dumps(_get_source(manifest, [int(year) for year in years.split("-")], type),
+                                  sort_keys=True) for type, years in zip(index["type"], index["years"])]
+    index.to_parquet(_INDEX_FILENAME + ".tmp", index=False)
+    os.replace(_INDEX_FILENAME + ".tmp", _INDEX_FILENAME)
+
+
+def _read_index():
+    """
+    Reads the index of the cube, which is cached until the file changes
+    :return: A dataframe of the statistics of each column of the cube, indexed by geography, years, and path
+    """
+    mtime = os.stat(_INDEX_FILENAME).st_mtime_ns
+    if _index_cache.get("mtime") != mtime:
+        _index_cache["index"] = pd.read_parquet(_INDEX_FILENAME).set_index(["type", "years", PATH_COL]).sort_index()
+        _index_cache["mtime"] = mtime
+    return _index_cache["index"]
+
+
+def get_path(strings, census_data):
+    """
+    Gets the path of the characteristic plotted in every year, if the same characteristic is plotted in every year
+    :param strings: A tuple of the characteristic names, nodes or derived metrics to be plotted
+    :param census_data: A list of census objects
+    :return: The path, or None if the plot does not plot a single characteristic
+    """
+    paths = set()
+    for i, cen in enumerate(census_data):
+        if isinstance(strings[i], metrics.Metric):
+            return None
+        nodes = dataset.find_nodes(cen.char_tree, strings[i])
+        if len(nodes) != 1:
+            return None
+        paths.add(dataset.get_path(nodes[0]))
+
+    return paths.pop() if len(paths) == 1 else None
+
+
+def lookup(strings, census_data, type):
+    """
+    Looks up the data of a plot within the cube
+    :param strings: A tuple of the characteristic names or derived metrics to be plotted
+    :param census_data: A list of census objects, in chronological order
+    :param type: The type of geography
+    :return: A dataframe indexed by geocode, with columns of the data and flags of each year and of each function,
+    and a dataframe of the statistics of each column. None if the plot is not within the cube or the cube is stale.
+    """
+    if not os.path.isfile(_INDEX_FILENAME):
+        return None
+
+    path = get_path(strings, census_data)
+    years = [cen.year for cen in census_data]
+    if path is None or years != sorted(years):
+        return None
+
+    key = (type, "-".join(str(year) for year in years), path)
+    index = _read_index()
+    if key not in index.index:
+        return None
+
+    stats = index.loc[[key]]
+    if stats["source"].iloc[0] != json.dumps(_get_source(Manifest(), years, type), sort_keys=True):
+        print("The cube is stale, rebuild it with cube.py")
+        return None
+
+    data_df = pq.read_table(stats["file"].iloc[0], filters=[(PATH_COL, "==", path)]).to_pandas()
+    data_df[GEOCODE_COL] = data_df[GEOCODE_COL].astype(str)
+    return data_df.set_index(GEOCODE_COL), stats.set_index("column")[_STAT_COLUMNS]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Precompute the data of every characteristic, geography, and year")
+    parser.add_argument("--processes", type=int, help="The number of processes to use")
+    args = parser.parse_args()
+
+    main.process_data()
+    main.load_data()
+
+    build_cube(args.processes)
@@ -0,0 +1,237 @@
+import os
+import shutil
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from anytree import Node, PreOrderIter
+from constants import TREE_SEPARATOR
+
+# Census data is stored as a parquet dataset that is partitioned by the top level branch of the characteristic tree and
+# by province. Within each partition rows are sorted by characteristic and geocode, so the row group statistics allow
+# a query for a single characteristic to skip almost all of the data.
+BRANCH_COL = "branch"
+PROVINCE_COL = "province"
+CHAR_INDEX_COL = "char_index"
+VALUE_COL = "value"
+FLAG_COL = "flag"
+MISSING_FLAG = "not available"
+# Separates the names of characteristics within a path through the characteristic tree
+PATH_SEPARATOR = ">"
+# Begins a path that leaves out its leading levels, such as "... > Renter"
+PARTIAL_PATH = "..."
+_PARTITIONING = ds.partitioning(pa.schema([(BRANCH_COL, pa.int32()), (PROVINCE_COL, pa.string())]), flavor="hive")
+_ROWS_PER_GROUP = 10000
+_PROVINCE_CODE_LENGTH = 2
+
+# Symbols used by statistics canada in place of data, see https://www.statcan.gc.ca/en/concepts/definitions/guide-symbol
+_FLAGS = {"x": "suppressed", "X": "suppressed", "F": "too unreliable", "..": MISSING_FLAG, "...": "not applicable"}
+_FLAG_CATEGORIES = sorted(set(_FLAGS.values()))
+
+
+def write_dataset(cen, data_df):
+    """
+    Writes the data of a census to a partitioned parquet dataset
+    :param cen: The census that the data belongs to
+    :param data_df: A dataframe of the census CSV
+    :return: None
+    """
+    data_df = data_df.dropna(subset=[cen.geocode_col])
+    geocodes = data_df[cen.geocode_col]
+
+    # Characteristics indented by less than a single level start a new top level branch, as within
+    # main.build_characteristic_tree
+    characteristics = data_df[cen.characteristic_col].fillna("").str.replace(u'\xa0', u' ')
+    spaces = characteristics.str.len() - characteristics.str.lstrip().str.len()
+    is_top = (spaces // cen.leading_spaces) == 0
+
+    # Totals are parsed once, with the reason for any missing total kept as a data quality flag. The symbol is held
+    # within the total column, or within a separate column for some censuses
+    totals = data_df[cen.total_col].str.strip()
+    values = pd.to_numeric(totals, errors="coerce")
+    symbols = totals.map(_FLAGS)
+    if cen.symbol_col is not None:
+        symbols = data_df[cen.symbol_col].str.strip().map(_FLAGS).combine_first(symbols)
+    flags = symbols.fillna(MISSING_FLAG).where(values.isna())
+
+    data_df = data_df.assign(**{
+        # Every geography lists the characteristics in the same order as the characteristic tree, so the position of a
+        # row within its geography identifies its node in the tree
+        CHAR_INDEX_COL: geocodes.groupby(geocodes, sort=False).cumcount().astype("int32"),
+        BRANCH_COL: is_top.groupby(geocodes, sort=False).cumsum().astype("int32"),
+        # The first digits of the standard geographical code identify the province
+        PROVINCE_COL: geocodes.str[:_PROVINCE_CODE_LENGTH],
+        VALUE_COL: values.astype("float64"),
+        FLAG_COL: pd.Categorical(flags, categories=_FLAG_CATEGORIES)
+    })
+
+    data_df = data_df.sort_values([BRANCH_COL, PROVINCE_COL, CHAR_INDEX_COL, cen.geocode_col])
+
+    # Replace any prior version of the data, including the single parquet files that were previously used
+    if os.path.isdir(cen.filename_par):
+        shutil.rmtree(cen.filename_par)
+    elif os.path.isfile(cen.filename_par):
+        os.remove(cen.filename_par)
+
+    ds.write_dataset(pa.Table.from_pandas(data_df, preserve_index=False), cen.filename_par, format="parquet",
+                     partitioning=_PARTITIONING, max_rows_per_group=_ROWS_PER_GROUP,
+                     min_rows_per_group=_ROWS_PER_GROUP, existing_data_behavior="delete_matching")
+
+
+def open_dataset(cen):
+    """
+    Opens the partitioned parquet dataset of a census without reading any data
+    :param cen: The census
+    :return: A pyarrow dataset
+    """
+    return ds.dataset(cen.filename_par, format="parquet", partitioning=_PARTITIONING)
+
+
+def write_arrow(cen):
+    """
+    Writes the data of a census to an uncompressed arrow IPC file that can be memory-mapped. Data is streamed from the
+    parquet dataset in batches, so the census is never held in memory as a whole.
+    :param cen: The census
+    :return: None
+    """
+    scanner = open_dataset(cen).scanner()
+    temp_filename = cen.filename_arrow + ".tmp"
+
+    with pa.OSFile(temp_filename, "wb") as sink:
+        with pa.ipc.new_file(sink, scanner.projected_schema) as writer:
+            for batch in scanner.to_batches():
+                writer.write_batch(batch)
+
+    os.replace(temp_filename, cen.filename_arrow)
+
+
+def load_arrow(cen):
+    """
+    Memory-maps the arrow IPC file of a census as a dataframe with arrow backed dtypes. No data is copied: pages are only
+    read from disk when a column is used, and are shared through the page cache by every process that maps the file.
+    :param cen: The census
+    :return: A pandas dataframe
+    """
+    with pa.memory_map(cen.filename_arrow, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def get_label(node):
+    """
+    Gets the name of a characteristic node without its numbering
+    :param node: A node of a characteristic tree
+    :return: The name as a string
+    """
+    return node.name.split(TREE_SEPARATOR)[-1]
+
+
+def get_branch(node):
+    """
+    Gets the top level branch of the characteristic tree that a node belongs to
+    :param node: A node of a characteristic tree
+    :return: The branch number as an int
+    """
+    return int(node.name.split(TREE_SEPARATOR)[0])
+
+
+def get_char_indices(char_tree):
+    """
+    Gets the row position of every characteristic within a geography
+    :param char_tree: The characteristic tree of a census
+    :return: A dictionary mapping nodes to their index
+    """
+    # The tree is built from the rows in order, so a pre-order traversal (excluding the root) visits rows in order
+    return {node: i - 1 for i, node in enumerate(PreOrderIter(char_tree)) if i > 0}
+
+
+def find_nodes(char_tree, name):
+    """
+    Finds all nodes of a characteristic tree with a name
+    :param char_tree: The characteristic tree of a census
+    :param name: The name of the characteristic, without its numbering, or a path within square brackets which is
+    resolved to a single node with resolve_path, or a node of the tree, which is found as is
+    :return: A list of nodes
+    """
+    if isinstance(name, Node):
+        return [name]
+    if name.startswith("[") and name.endswith("]"):
+        return [resolve_path(char_tree, name[1:-1])]
+
+    nodes = [node for node in PreOrderIter(char_tree) if node is not char_tree and get_label(node) == name]
+
+    if len(nodes) == 0:
+        raise ValueError(f"No characteristic named {name} exists")
+
+    return nodes
+
+
+def resolve_path(char_tree, path):
+    """
+    Finds the node of a characteristic tree that a path refers to
+    :param char_tree: The characteristic tree of a census
+    :param path: The names of characteristics from the top of the tree down separated by PATH_SEPARATOR. Leading
+    levels may be left out by starting the path with PARTIAL_PATH, in which case the remaining path must be unique.
+    :return: The node
+    """
+    names = [name.strip() for name in path.split(PATH_SEPARATOR)]
+    partial = names[0] == PARTIAL_PATH
+    if partial:
+        names = names[1:]
+
+    nodes = []
+    for node in PreOrderIter(char_tree):
+        if node is char_tree:
+            continue
+        node_names = get_path(node).split(PATH_SEPARATOR)
+        if node_names == names or (partial and node_names[-len(names):] == names):
+            nodes.append(node)
+
+    if len(nodes) == 0:
+        raise ValueError(f"No characteristic matches the path {path}")
+    elif len(nodes) > 1:
+        raise ValueError(f"{len(nodes)} characteristics match the path {path}, include more of the path to clarify")
+
+    return nodes[0]
+
+
+def get_path(node):
+    """
+    Gets the path of a characteristic node that can be resolved with resolve_path
+    :param node: A node of a characteristic tree
+    :return: The path as a string
+    """
+    return PATH_SEPARATOR.join(get_label(n).strip() for n in node.path[1:])
+
+
+def read_values(cen, nodes, geocodes=None, columns=None):
+    """
+    Reads the rows of characteristics from a census. Only the partitions and row groups that may hold the rows are read.
+    :param cen: The census to read from
+    :param nodes: A list of nodes of the characteristic tree of the census
+    :param geocodes: The geocodes to read rows for. If None, rows for all geographies are read.
+    :param columns: The columns to read. If None, all columns are read.
+    :return: A pandas dataframe
+    """
+    char_indices = get_char_indices(cen.char_tree)
+    indices = [char_indices[node] for node in nodes]
+
+    if geocodes is not None:
+        geocodes = [str(geocode) for geocode in geocodes]
+
+    # Census data that is memory-mapped is filtered in place, otherwise it is read from the dataset
+    if cen.data_df is not None:
+        mask = cen.data_df[CHAR_INDEX_COL].isin(indices)
+        if geocodes is not None:
+            mask &= cen.data_df[cen.geocode_col].isin(geocodes)
+
+        data_df = cen.data_df[mask.to_numpy(dtype=bool, na_value=False)]
+        return data_df if columns is None else data_df[columns]
+
+    expression = (ds.field(BRANCH_COL).isin(sorted({get_branch(node) for node in nodes})) &
+                  ds.field(CHAR_INDEX_COL).isin(indices))
+
+    if geocodes is not None:
+        provinces = sorted({geocode[:_PROVINCE_CODE_LENGTH] for geocode in geocodes})
+        expression &= ds.field(PROVINCE_COL).isin(provinces) & ds.field(cen.geocode_col).isin(geocodes)
+
+    return open_dataset(cen).to_table(columns=columns, filter=expression).to_pandas()
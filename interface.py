@@ -8,18 +8,20 @@ import tkinter as tk
 from tkinter import ttk
 from tkinter.ttk import Frame, Button, Label, Radiobutton, Checkbutton
 import census
-import main
+import constants
 import map_plot
+import metrics
 
 TITLE = "Canadian Census Analyzer"
-_PROCESSING_METHODS = ("Mean Difference", "Mean Percent Change", "Mean Percent Difference")
-_GEOGRAPHY = ("Census Subdivisions", "Census Divisions", "Provinces")
+_PROCESSING_METHODS = constants.FUNC_NAMES
+_GEOGRAPHY = constants.GEOGRAPHIES
 _DATA_CLIP = ("Yes", "No")
 
 _year_checkbuttons = []
 _pm_radio_var = None
 _data_clip_var = None
 _geo_var = None
+_metric_var = None
 _year_selectors = []
 _stackcombos = []
 _root = None
@@ -30,7 +32,7 @@ def generate_interface():
     Create a UI to allow creation of a map
     :return: None
     """
-    global _pm_radio_var, _data_clip_var, _geo_var
+    global _pm_radio_var, _data_clip_var, _geo_var, _metric_var
 
     root = tk.Tk()
     root.title(TITLE)
@@ -92,6 +94,13 @@ def generate_interface():
         r = Radiobutton(outlier_frame, text=_DATA_CLIP[i], value=_DATA_CLIP[i], var=_data_clip_var)
         r.grid(row=0, column=i)
 
+    # Derived Metric
+    tk.Label(root, text="Optionally, enter a derived metric to plot instead of the values selected below, "
+                        "e.g. [Total - Age > 65 years and over] / [Total - Age] * 1000:").pack(fill="x", pady=10)
+
+    _metric_var = tkinter.StringVar()
+    ttk.Entry(root, textvariable=_metric_var, width=150).pack(fill="x", padx=10, pady=10)
+
     # Value Selection
     for i, cen in enumerate(census.censuses):
         _year_selectors.append(Frame(root))
@@ -125,11 +134,24 @@ def create_plot():
     cen = []
     strings = []
     func = None
+    metric = None
+
+    if _metric_var.get().strip():
+        metric = metrics.Metric(_metric_var.get().strip())
 
     for i, check_val in enumerate(_year_checkbuttons):
         if check_val.get():
             cen.append(census.censuses[i])
-            strings.append(_stackcombos[i].get_final_val())
+            if metric is not None:
+                strings.append(metric)
+                continue
+
+            # The chosen node itself is passed, as the same name may be used by multiple characteristics
+            node = _stackcombos[i].get_final_node()
+            if node is None:
+                print(f"No characteristic is selected for {census.censuses[i].year}")
+                return
+            strings.append(node)
 
     func_name = _pm_radio_var.get()
 
@@ -174,29 +196,30 @@ class StackCombo(tk.Frame):
         values = []
         # Remove the separator
         for i, ch in enumerate(node.children):
-            values.append(ch.name.split(main.TREE_SEPARATOR)[-1])
+            values.append(ch.name.split(constants.TREE_SEPARATOR)[-1])
 
         self.combo = ttk.Combobox(self, values=values, **kwargs)
         self.combo.bind("<<ComboboxSelected>>", self.field_change)
         self.combo.pack(side="left", fill="x", padx=10)
 
-    @staticmethod
-    def _get_child_by_name(node, name):
-        for child in node.children:
-            if name in child.name:
-                return child
-
-        raise Exception("No child by that name exists")
+    def get_selected_node(self):
+        """
+        Gets the node selected within this stack combo
+        :return: The node, or None if nothing is selected
+        """
+        if self.combo.current() < 0:
+            return None
+        return self.node.children[self.combo.current()]
 
-    def get_final_val(self):
+    def get_final_node(self):
         """
-        Gets the value of the stack combo that is lowest down in the hierarchy, be it this stack combo or a child
-        :return: A string of the stack combo text
+        Gets the node selected lowest down in the hierarchy, be it within this stack combo or a child
+        :return: The node, or None if nothing is selected
         """
-        if self.child is not None:
-            return self.child.get_final_val()
+        if self.child is not None and self.child.get_final_node() is not None:
+            return self.child.get_final_node()
 
-        return self.combo.get()
+        return self.get_selected_node()
 
     def field_change(self, _):
         """
@@ -210,7 +233,8 @@ class StackCombo(tk.Frame):
             self.child.destroy()
 
         # Add new children if there are any child nodes
-        child_node = StackCombo._get_child_by_name(self.node, self.combo.get())
+        self.child = None
+        child_node = self.get_selected_node()
         if len(child_node.children) > 0:
             self.child = StackCombo(self.master, child_node, self, width=150)
             self.child.pack(fill="x", pady=10)
@@ -2,6 +2,7 @@
 # Network with him at: https://www.linkedin.com/in/samuellehmann/
 # Date: 2023-01-19
 
+import argparse
 import os
 import pickle
 import shutil
@@ -9,14 +10,21 @@ import time
 import urllib.request
 import zipfile
 import pandas as pd
+import pyarrow.dataset as ds
 from anytree import Node
 import census
+import concordance
+import dataset
 import interface
+import simplify
+from constants import TREE_SEPARATOR
+from manifest import Manifest
 
-TREE_SEPARATOR = "⤚"
-_NODE_FILENAME = "nodes_list.pickle"
 _ZIP_FILENAME = "download.zip"
 _TEMP_LOC = '\\temp'
+_ALBERTA_CODE = "48"
+# Incremented when the way characteristic trees are built changes, so that pickled trees are rebuilt
+_TREE_VERSION = 2
 
 
 def download_csv(url, keep_file, filename, remove_first_line=False):
@@ -26,38 +34,63 @@ def download_csv(url, keep_file, filename, remove_first_line=False):
     :param keep_file: The file that should be kept from the zip file
     :param filename: The final filename that the csv should be saved as
     :param remove_first_line: Should the first line of the CSV be removed? Some CSVs have an additional header text
-    :return: None
+    :return: The version of the remote file, see get_remote_version
     """
-    # Create a temporary directory
+    # Create a temporary directory, removing any left behind by an interrupted download
     loc = os.getcwd() + _TEMP_LOC + "\\"
+    if os.path.isdir(loc):
+        shutil.rmtree(loc)
     os.mkdir(loc)
 
     # Download the file as a zip file and extract it
     print(f"Start File Download At This URL: {url}")
-    urllib.request.urlretrieve(url, loc + _ZIP_FILENAME)
+    _, headers = urllib.request.urlretrieve(url, loc + _ZIP_FILENAME)
     print("Download Complete")
     with zipfile.ZipFile(loc + _ZIP_FILENAME, 'r') as zip_ref:
         zip_ref.extractall(loc)
 
-    # Rename/move the file of interest and delete the temporary directory
-    os.rename(loc + keep_file, os.getcwd() + "\\" + filename)
-    shutil.rmtree(loc)
-
     # Sometimes the first line has to be removed due to additional header text
     if remove_first_line:
-        with open(filename, 'r') as fin:
+        with open(loc + keep_file, 'r') as fin:
             data = fin.read().splitlines(True)
-        with open(filename, 'w') as fout:
+        with open(loc + keep_file, 'w') as fout:
             fout.writelines(data[1:])
 
+    # Move the file of interest into place only once it is complete, then delete the temporary directory
+    os.replace(loc + keep_file, os.getcwd() + "\\" + filename)
+    shutil.rmtree(loc)
+
+    return _remote_version(headers)
+
+
+def get_remote_version(url):
+    """
+    Gets the version of a file hosted by statistics canada without downloading it, so that revisions can be detected
+    :param url: The URL of the file
+    :return: A dictionary of the headers that identify the version of the file
+    """
+    request = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(request) as response:
+        return _remote_version(response.headers)
+
+
+def _remote_version(headers):
+    """
+    Extracts the headers that identify the version of a remote file
+    :param headers: The headers of a http response
+    :return: A dictionary of the headers that identify the version of the file
+    """
+    return {header: headers.get(header) for header in ("ETag", "Last-Modified", "Content-Length")}
+
 
 def save_csv_parquet(cen):
     """
-    Loading CSVs are timeconsuming. Read in the CSV and save it as a parquet file which will be quicker to load in the future
+    Loading CSVs are timeconsuming. Read in the CSV and save it as a partitioned parquet dataset which will be quicker to
+    query in the future
     :return: The CSV as a dataframe
     """
     df = pd.read_csv(cen.filename_csv, encoding="latin-1", dtype="str")
-    df.to_parquet(cen.filename_par, compression=None)
+    dataset.write_dataset(cen, df)
     return df
 
 
@@ -160,8 +193,9 @@ def build_characteristic_tree(characteristic_list, leading_spaces=2):
 
             characteristic = prior_prefix + characteristic
 
-            node = Node(characteristic, prior)
-            parent = prior
+            # After climbing the tree, the prior node is the sibling of this node
+            node = Node(characteristic, prior.parent)
+            parent = prior.parent
 
         prior = node
         prior_whitespace = white_space_chars
@@ -169,61 +203,139 @@ def build_characteristic_tree(characteristic_list, leading_spaces=2):
     return start_node
 
 
-def process_data():
+def process_data(refresh=False, memory_map=False):
     """
-    Loads data from CSV files and builds a characteristic tree. This information is saved as a parquet and pickle respectively.
-    :return:
+    Downloads and processes the data of every census. Every stage is recorded within a manifest, and only the stages
+    that are stale for a census are rebuilt. Stages are only recorded once complete, so an interrupted run resumes from
+    the last completed stage.
+    :param refresh: Should statistics canada be checked for revisions of the downloaded files?
+    :param memory_map: Should arrow files be built so that the data can be memory-mapped?
+    :return: None
     """
-    nodes = []
-    for i, cen in enumerate(census.censuses):
-        print(cen.year)
+    manifest = Manifest()
+
+    for cen in census.censuses:
+        build_census(cen, manifest, refresh, memory_map)
+
+    # Simplify any boundary files that have changed, and match the geographies of older censuses to them
+    simplify.simplify_boundaries()
+    concordance.build_concordances()
+
+
+def build_census(cen, manifest, refresh=False, memory_map=False):
+    """
+    Downloads a CSV file and processes it into a parquet dataset and a characteristic tree, skipping any stage that is
+    current.
+    The inputs of each stage include the hash of the outputs of the prior stage, so changes propagate downstream.
+    :param cen: The census to build
+    :param manifest: The manifest recording the completed stages
+    :param refresh: Should statistics canada be checked for a revision of the downloaded file?
+    :param memory_map: Should an arrow file be built so that the data can be memory-mapped?
+    :return: None
+    """
+    # Download the CSV
+    remote = get_remote_version(cen.url) if refresh else manifest.get_inputs(cen.year, "download").get("remote")
+    inputs = cen.get_config("url", "filename_keep", "delete_first_line")
+    inputs["remote"] = remote
+
+    # A CSV downloaded before the manifest was introduced is kept rather than downloaded again
+    manifest.adopt(cen.year, "download", inputs, [cen.filename_csv])
+    if not manifest.is_current(cen.year, "download", inputs, [cen.filename_csv]):
+        inputs["remote"] = download_csv(cen.url, cen.filename_keep, cen.filename_csv, cen.delete_first_line)
+        manifest.record(cen.year, "download", inputs, [cen.filename_csv])
+        print(f"Finished download of {cen.year} census data")
+
+    # Convert the CSV to a parquet dataset
+    inputs = cen.get_config("characteristic_col", "geocode_col", "total_col", "leading_spaces",
+                            "symbol_col")
+    inputs["csv"] = manifest.fingerprint(cen.filename_csv)
+    data_df = None
+
+    if not manifest.is_current(cen.year, "parquet", inputs, [cen.filename_par]):
+        print(f"Processing {cen.year} census data")
         data_df = save_csv_parquet(cen)
+        manifest.record(cen.year, "parquet", inputs, [cen.filename_par])
+
+    # Build the characteristic tree
+    inputs = cen.get_config("leading_spaces", "characteristic_col", "geo_col")
+    inputs["version"] = _TREE_VERSION
+    inputs["parquet"] = manifest.fingerprint(cen.filename_par)
+
+    if not manifest.is_current(cen.year, "tree", inputs, [cen.filename_tree]):
+        if data_df is None:
+            # Only the Alberta partition of the dataset needs to be read, it is then restored to the order of the CSV
+            data_df = dataset.open_dataset(cen).to_table(
+                columns=[cen.geocode_col, cen.geo_col, cen.characteristic_col, dataset.CHAR_INDEX_COL],
+                filter=ds.field(dataset.PROVINCE_COL) == _ALBERTA_CODE).to_pandas()
+            data_df = data_df.sort_values([cen.geocode_col, dataset.CHAR_INDEX_COL])
 
-        characteristic_list = data_df.where(data_df[cen.geo_col] == "Alberta")[
+        alberta_df = data_df[data_df[cen.geo_col] == "Alberta"]
+
+        # Some censuses label every geography within Alberta as Alberta, so only take the rows of the first geography
+        characteristic_list = alberta_df[alberta_df[cen.geocode_col] == alberta_df[cen.geocode_col].iloc[0]][
             cen.characteristic_col].dropna().to_numpy()
 
-        nodes.append(build_characteristic_tree(characteristic_list, cen.leading_spaces))
+        # Save the tree to a pickle
+        with open(cen.filename_tree, "wb") as file:
+            pickle.dump(build_characteristic_tree(characteristic_list, cen.leading_spaces), file)
+        manifest.record(cen.year, "tree", inputs, [cen.filename_tree])
+
+    # Convert the parquet dataset to an arrow file which can be memory-mapped
+    if memory_map:
+        inputs = {"parquet": manifest.fingerprint(cen.filename_par)}
 
-    # Save the nodelist to a pickle
-    file = open(_NODE_FILENAME, "ab")
-    pickle.dump(nodes, file)
-    file.close()
+        if not manifest.is_current(cen.year, "arrow", inputs, [cen.filename_arrow]):
+            print(f"Writing arrow file for {cen.year} census data")
+            dataset.write_arrow(cen)
+            manifest.record(cen.year, "arrow", inputs, [cen.filename_arrow])
 
 
-def load_data():
+def init_worker(memory_map=False):
     """
-    Loads characteristic trees and dataframes from pickles and parquets respectively
+    Loads census data within a worker process, unless it was inherited from the parent process
+    :param memory_map: Should census data be memory-mapped?
+    :return: None
+    """
+    if census.censuses[0].char_tree is None:
+        load_data(memory_map)
+
+
+def load_data(memory_map=False):
+    """
+    Loads characteristic trees from pickles. Census data is queried from the parquet datasets as it is needed, unless
+    it is memory-mapped.
+    :param memory_map: Should the data of each census be memory-mapped from its arrow file?
     :return:
     """
 
-    file = open(_NODE_FILENAME, "rb")
-    nodes = pickle.load(file)
+    for cen in census.censuses:
+        if memory_map:
+            cen.set_data_df(dataset.load_arrow(cen))
 
-    for i, cen in enumerate(census.censuses):
-        cen.set_data_df(pd.read_parquet(cen.filename_par))
-        cen.set_char_tree(nodes[i])
+        with open(cen.filename_tree, "rb") as file:
+            cen.set_char_tree(pickle.load(file))
 
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
-    print("Program Start")
+    parser = argparse.ArgumentParser(description=interface.TITLE)
+    parser.add_argument("--refresh", action="store_true",
+                        help="Check statistics canada for revised census files and rebuild any that changed")
+    parser.add_argument("--memory-map", action="store_true",
+                        help="Memory-map census data from arrow files, sharing one copy between processes")
+    args = parser.parse_args()
 
-    if not os.path.isfile(census.censuses[0].filename_par):
-        # Download CSVs
-        for cen in census.censuses:
-            download_csv(cen.url, cen.filename_keep, cen.filename_csv, cen.delete_first_line)
-            print(f"Finished download of {cen.year} census data")
+    print("Program Start")
 
-        process_data()
-    else:
-        print("Files already processed. No need to download files")
+    # Only stale stages are rebuilt, if all data is already processed this is quick
+    process_data(args.refresh, args.memory_map)
 
     current_time = time.time()
     geo_df = pd.read_csv("GeoData.CSV", encoding="latin-1")
     print(f"Done loading geo data in {time.time() - current_time} seconds")
 
     current_time = time.time()
-    load_data()
+    load_data(args.memory_map)
     print(f"Done loading data in {time.time() - current_time} seconds")
 
     interface.generate_interface()
@@ -0,0 +1,229 @@
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+
+MANIFEST_FILENAME = "build_manifest.json"
+_HASH_BLOCK_SIZE = 2 ** 20
+# A lock older than this was left behind by a process that was killed while saving
+_STALE_LOCK_SECONDS = 60
+_LOCK_POLL_SECONDS = 0.05
+
+
+def hash_path(path):
+    """
+    Computes a sha256 hash of a file, or of every file within a directory
+    :param path: The path of a file or directory
+    :return: The hex digest of the hash
+    """
+    sha = hashlib.sha256()
+
+    if os.path.isdir(path):
+        # Hash the relative name and contents of every file so that renames and edits are both detected
+        for directory, sub_dirs, files in os.walk(path):
+            sub_dirs.sort()
+            for name in sorted(files):
+                filename = os.path.join(directory, name)
+                sha.update(os.path.relpath(filename, path).replace("\\", "/").encode())
+                sha.update(hash_path(filename).encode())
+    else:
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(_HASH_BLOCK_SIZE), b""):
+                sha.update(block)
+
+    return sha.hexdigest()
+
+
+def _stat_path(path):
+    """
+    Gets a cheap signature of a file or directory, used to avoid rehashing files that have not changed
+    :param path: The path of a file or directory
+    :return: A list of the total size and the latest modification time
+    """
+    if not os.path.isdir(path):
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    size, mtime = 0, 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            stat = os.stat(os.path.join(directory, name))
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime_ns)
+    return [size, mtime]
+
+
+@contextmanager
+def _lock(filename):
+    """
+    Holds a lock file while the manifest is saved, so that processes saving at the same time do not overwrite each other
+    :param filename: The filename of the manifest
+    :return: A context manager
+    """
+    lock_filename = filename + ".lock"
+    while True:
+        try:
+            os.close(os.open(lock_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_filename) > _STALE_LOCK_SECONDS:
+                    os.remove(lock_filename)
+            except FileNotFoundError:
+                pass
+            time.sleep(_LOCK_POLL_SECONDS)
+
+    try:
+        yield
+    finally:
+        os.remove(lock_filename)
+
+
+def _read(filename):
+    """
+    Reads a manifest file
+    :param filename: The json file the manifest is stored within
+    :return: The data of the manifest, which is empty if the file does not exist
+    """
+    if os.path.isfile(filename):
+        with open(filename, "r") as file:
+            return json.load(file)
+    return {"stages": {}, "hashes": {}}
+
+
+class Manifest:
+    """
+    Records the inputs and outputs of every stage used to build the census data, so that only stale stages are rebuilt.
+    Entries are grouped by a key (the census year) and then by the name of the stage.
+    """
+
+    def __init__(self, filename=MANIFEST_FILENAME):
+        """
+        :param filename: The json file the manifest is stored within
+        """
+        self.filename = filename
+        # Outputs are only adopted by an install that predates the manifest, see adopt
+        self.is_new = not os.path.isfile(filename)
+        self.data = _read(filename)
+        # The stages and hashes recorded by this process, which are merged into the file when it is saved
+        self._recorded = set()
+        self._hashed = set()
+
+    def fingerprint(self, path):
+        """
+        Gets the hash of a file or directory. Hashes are cached against the size and modification time of the path so
+        that large files are only rehashed when they change.
+        :param path: The path of a file or directory
+        :return: The hex digest of the hash, or None if the path does not exist
+        """
+        if not os.path.exists(path):
+            return None
+
+        stat = _stat_path(path)
+        cached = self.data["hashes"].get(path)
+        if cached is not None and cached["stat"] == stat:
+            return cached["sha256"]
+
+        print(f"Hashing {path}")
+        sha = hash_path(path)
+        self.data["hashes"][path] = {"stat": stat, "sha256": sha}
+        self._hashed.add(path)
+        return sha
+
+    def get_inputs(self, key, stage):
+        """
+        Gets the inputs that were recorded when a stage was last completed
+        :param key: The key the stage is grouped under
+        :param stage: The name of the stage
+        :return: A dictionary of inputs, or an empty dictionary if the stage has never completed
+        """
+        entry = self.data["stages"].get(str(key), {}).get(stage)
+        return {} if entry is None else entry["inputs"]
+
+    def get_outputs(self, key, stage):
+        """
+        Gets the hashes of the outputs that were recorded when a stage was last completed
+        :param key: The key the stage is grouped under
+        :param stage: The name of the stage
+        :return: A dictionary of output paths and their hashes, or an empty dictionary if the stage has never completed
+        """
+        entry = self.data["stages"].get(str(key), {}).get(stage)
+        return {} if entry is None else entry["outputs"]
+
+    def is_current(self, key, stage, inputs, outputs):
+        """
+        Determines whether a stage is up-to-date: it must have completed with identical inputs and all of its outputs
+        must be unchanged since then
+        :param key: The key the stage is grouped under
+        :param stage: The name of the stage
+        :param inputs: A json serializable dictionary of everything the stage depends on
+        :param outputs: A list of the paths that the stage produces
+        :return: True if the stage does not need to be rebuilt
+        """
+        entry = self.data["stages"].get(str(key), {}).get(stage)
+        if entry is None or entry["inputs"] != json.loads(json.dumps(inputs)):
+            return False
+
+        for path in outputs:
+            if entry["outputs"].get(path) is None or self.fingerprint(path) != entry["outputs"][path]:
+                return False
+
+        return True
+
+    def record(self, key, stage, inputs, outputs):
+        """
+        Records that a stage has completed and saves the manifest
+        :param key: The key the stage is grouped under
+        :param stage: The name of the stage
+        :param inputs: A json serializable dictionary of everything the stage depends on
+        :param outputs: A list of the paths that the stage produced
+        :return: None
+        """
+        self.data["stages"].setdefault(str(key), {})[stage] = {
+            "inputs": inputs,
+            "outputs": {path: self.fingerprint(path) for path in outputs}
+        }
+        self._recorded.add((str(key), stage))
+        self.save()
+
+    def adopt(self, key, stage, inputs, outputs):
+        """
+        Records a stage as completed if it has never been recorded but all of its outputs already exist, so that files
+        produced before the manifest was introduced are kept rather than rebuilt. Only an install without a manifest
+        file adopts outputs, since otherwise a missing record means the stage was interrupted before it finished
+        :param key: The key the stage is grouped under
+        :param stage: The name of the stage
+        :param inputs: A json serializable dictionary of everything the stage depends on
+        :param outputs: A list of the paths that the stage produces
+        :return: True if the stage was adopted
+        """
+        if not self.is_new or self.data["stages"].get(str(key), {}).get(stage) is not None:
+            return False
+        if not all(os.path.exists(path) for path in outputs):
+            return False
+
+        print(f"Adopting the existing outputs of the {stage} stage of {key}")
+        self.record(key, stage, inputs, outputs)
+        return True
+
+    def save(self):
+        """
+        Saves the manifest. Other processes may have saved the manifest since it was read, so the stages and hashes
+        recorded by this process are merged into the latest file under a lock. The file is replaced atomically so that
+        an interruption can not corrupt it.
+        :return: None
+        """
+        with _lock(self.filename):
+            data = _read(self.filename)
+            for key, stage in self._recorded:
+                data["stages"].setdefault(key, {})[stage] = self.data["stages"][key][stage]
+            for path in self._hashed:
+                data["hashes"][path] = self.data["hashes"][path]
+
+            temp_filename = self.filename + ".tmp"
+            with open(temp_filename, "w") as file:
+                json.dump(data, file, indent=2)
+            os.replace(temp_filename, self.filename)
+
+        self.data = data
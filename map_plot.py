@@ -3,11 +3,18 @@
 # Date: 2023-01-19
 
 import math
+import os
 import webbrowser
 import folium
 import geopandas as gpd
 import jinja2
 import numpy as np
+import concordance
+import cube
+import dataset
+import metrics
+import simplify
+from constants import FUNC_NAMES
 
 # Source for map data: https://www12.statcan.gc.ca/census-recensement/alternative_alternatif.cfm?l=eng&dispext=zip&teng=lcsd000b21a_e.zip&k=%20%20%20152326&loc=//www12.statcan.gc.ca/census-recensement/2021/geo/sip-pis/boundary-limites/files-fichiers/lcsd000b21a_e.zip
 
@@ -16,71 +23,57 @@ _ROUND_DECS = 2
 _THRESHOLD_LEVELS = 30
 _START_LOCATION = [63, -102]
 
+_CAD_FILENAMES = {"Census Subdivisions": "mapData/simplified/Census Sub Divisions/lcsd000b21a_e.shp",
+                  "Census Divisions": "mapData/simplified/Census Divisions/lcd_000b21a_e.shp",
+                  "Provinces": "mapData/simplified/Provinces/lpr_000b21a_e.shp"}
+
+_cad_cache = {}
+# Derived metrics are evaluated for every geography by a single evaluator, so that the values and sub-expressions it
+# caches are reused by every map made within the process, such as by the jobs of a batch
+_evaluator = metrics.Evaluator()
+
 
 def plot_map(function_name, strings, census_data, func=None, type="Census Subdivisions", clipped=False):
     """
     Creates a map and displays it using folium
     :param census_data: A list of census objects
     :param function_name: The name of the function that operates on data from multiple years
-    :param strings: A tuple of the characteristic names to be plotted
-    :param func: A function to act on data from each of the years
+    :param strings: A tuple of the characteristic names, nodes or derived metrics to be plotted
+    :param func: A function to act on data from each of the years. It is given a matrix with a row for each year and a
+    column for each geography, and returns the value of each geography, see mean_difference
     :param type: The type of map to be displayed: CSD, Provinces, or LCD. See https://www12.statcan.gc.ca/census-recensement/2016/ref/dict/figures/f1_1-eng.cfm
     :param clipped: Whether or not data with the outliers clipped should be displayed
     :return:
     """
-    cad = get_cad_file(type)
-    geo_level, geo_name, prop_name = get_property_names(type)
+    output_map(build_map(function_name, strings, census_data, func, type, clipped))
 
-    # Create data column for every type of data
-    for census in census_data:
-        cad[str(census.year)] = 0
-
-    # Simplify first data
-    census_data[0].data_df = census_data[0].data_df.query(
-        f"{census_data[0].geocode_col} in @cad['{geo_level}'] and @strings[0] in `{census_data[0].characteristic_col}`")
-
-    if len(census_data) == 1:  # There is only one year
-        for index, datum in census_data[0].data_df.query(
-                f"`{census_data[0].characteristic_col}` in @strings[0]").iterrows():
-            try:
-                cad.loc[cad[geo_level] == datum[census_data[0].geocode_col], str(census_data[0].year)] = float(
-                    datum[census_data[0].total_col])
-            except (TypeError, ValueError):
-                # If there is a data quality issue, the data is given as a NAN
-                cad.loc[cad[geo_level] == datum[census_data[0].geocode_col], str(census_data[0].year)] = np.NAN
-    else:  # There are multiple data sources
-        cad[function_name] = 0
-
-        # Simplify the data by eliminating rows that are not needed
-        # first reduce the first column to it's minimum length and then simplify the other columns based on the reduced first column
-        for i in range(1, len(census_data)):
-            x = census_data[i].data_df[census_data[i].geocode_col]
-            census_data[0].data_df = census_data[0].data_df.query(f"{census_data[0].geocode_col} in @x")
-        for i in range(1, len(census_data)):
-            x = census_data[0].data_df[census_data[0].geocode_col]
-            census_data[i].data_df = census_data[i].data_df.query(
-                f"(`{census_data[i].characteristic_col}` in @strings[@i]) and ({census_data[i].geocode_col} in @x)")
-
-        proc_rows(census_data, function_name, func, cad, geo_level, strings)
+
+def build_map(function_name, strings, census_data, func=None, type="Census Subdivisions", clipped=False):
+    """
+    Creates a folium map, see plot_map for a description of the parameters
+    :return: A folium map
+    """
+    geo_level, geo_name, prop_name = get_property_names(type)
+    cad, names, flags, stats = build_cad(function_name, strings, census_data, func, type)
 
     m = folium.Map(location=_START_LOCATION, zoom_start=4)
 
     if len(census_data) == 1:
         if clipped:
-            column = str(census_data[0].year) + " clipped"
-            cad[str(census_data[0].year) + " clipped"] = clip_outliers(cad[str(census_data[0].year)])
+            column = clip_df_column(str(census_data[0].year), cad, stats)
 
         else:
             column = str(census_data[0].year)
 
-        choro = gen_choropleth(cad, geo_level, column, prop_name, strings[0], census_data[0].year)
+        choro = gen_choropleth(cad, geo_level, column, prop_name, names[0], census_data[0].year)
         choro.add_to(m)
 
         hover_fields = [str(census_data[0].year), geo_name, geo_level]
+        display_fields = [gen_display_column(cad, str(census_data[0].year), flags[0]), geo_name, geo_level]
 
     else:
         if clipped:
-            column = clip_df_column(function_name, cad)
+            column = clip_df_column(function_name, cad, stats)
         else:
             column = function_name
 
@@ -92,119 +85,216 @@ def plot_map(function_name, strings, census_data, func=None, type="Census Subdiv
         for i in range(0, len(census_data)):
 
             if clipped:
-                columns.append(clip_df_column(str(census_data[i].year), cad))
+                columns.append(clip_df_column(str(census_data[i].year), cad, stats))
             else:
                 columns.append(str(census_data[i].year))
 
-        thresholds = det_thresholds(cad, columns)
+        thresholds = det_thresholds(cad, columns, stats)
 
         for i, column in enumerate(columns):
             # Create the choropleth, where only the first year is shown
-            choro = gen_choropleth(cad, geo_level, column, prop_name,
-                                   census_data[i].data_df[census_data[i].characteristic_col].values[0],
-                                   census_data[i].year, thresholds, show=i == 0)
+            choro = gen_choropleth(cad, geo_level, column, prop_name, names[i], census_data[i].year, thresholds,
+                                   show=i == 0)
             choro.add_to(m)
 
         lc = gen_layer_controller()
         lc.add_to(m)
 
         hover_fields = []
+        display_fields = []
         for i in range(len(census_data)):
             hover_fields.append(str(census_data[i].year))
+            display_fields.append(gen_display_column(cad, str(census_data[i].year), flags[i]))
         hover_fields.extend([function_name, geo_name, geo_level])
+        display_fields.extend([gen_display_column(cad, function_name, flags[-1]), geo_name, geo_level])
 
-    hover_bubble = gen_hover_bubble(cad, hover_fields)
+    hover_bubble = gen_hover_bubble(cad, display_fields, hover_fields)
     m.add_child(hover_bubble)
     m.keep_in_front(hover_bubble)
 
-    output_map(m)
+    return m
 
 
-def clip_df_column(unclipped_column, df):
+def build_cad(function_name, strings, census_data, func=None, type="Census Subdivisions"):
+    """
+    Reads the geography of a map and adds a column for the data of each year and, if there are multiple years, for
+    function data. The data is looked up from the cube if it has been built (see cube.py), otherwise it is computed.
+    See plot_map for a description of the parameters
+    :return: The geopandas dataframe, a list of the names of the data of each census, a list of the data quality
+    flags of each column (see proc_columns), and a dataframe of precomputed statistics of each column (or None)
+    """
+    cad = get_cad_file(type)
+    geo_level = get_property_names(type)[0]
+
+    # Only the functions within FUNC_LIST are precomputed
+    served = cube.lookup(strings, census_data, type)
+    if served is not None and (func is None or function_name in FUNC_NAMES):
+        data_df, stats = served
+        geocodes = cad[geo_level].astype(str)
+        flags = []
+        for census in census_data:
+            cad[str(census.year)] = geocodes.map(data_df[str(census.year)])
+            flags.append(geocodes.map(data_df[str(census.year) + cube.FLAG_SUFFIX]).astype(object))
+
+        if len(census_data) > 1 and func is not None:
+            cad[function_name] = geocodes.map(data_df[function_name])
+            flags.append(combine_flags(flags))
+
+        names = [dataset.get_label(dataset.find_nodes(census.char_tree, strings[i])[0])
+                 for i, census in enumerate(census_data)]
+        return cad, names, flags, stats
+
+    # Only read the rows of the plotted characteristics for the geographies within the cad file
+    data_dfs = [read_data(census, strings[i], cad[geo_level], type) for i, census in enumerate(census_data)]
+
+    flags = proc_columns(census_data, data_dfs, function_name, func, cad, geo_level)
+    names = [data_dfs[i][census.characteristic_col].values[0] for i, census in enumerate(census_data)]
+    return cad, names, flags, None
+
+
+def read_data(census, string, geocodes=None, type="Census Subdivisions"):
+    """
+    Reads the rows of a characteristic or derived metric of a census for the geographies of a boundary file. Older
+    censuses are read for their own geographies and then interpolated onto the geographies of the boundary file, if a
+    concordance has been built
+    :param census: The census to read from
+    :param string: A characteristic name, [path] or node, or a derived metric
+    :param geocodes: The geocodes of the boundary file to read rows for. If None, rows for all geographies are read
+    :param type: The type of geography
+    :return: A dataframe with the geocode, characteristic, value and flag columns, see dataset.read_values
+    """
+    conc = concordance.get_concordance(census.year, type)
+    if conc is not None:
+        geocodes = conc.old_geocodes
+
+    if isinstance(string, metrics.Metric):
+        characteristic = string
+        data_df = _evaluator.evaluate([string], census)[0]
+        if geocodes is not None:
+            data_df = data_df[data_df[census.geocode_col].isin([str(geocode) for geocode in geocodes])]
+    else:
+        nodes = dataset.find_nodes(census.char_tree, string)
+        characteristic = nodes[0]
+        data_df = dataset.read_values(census, nodes, geocodes, [census.geocode_col, census.characteristic_col,
+                                                                dataset.VALUE_COL, dataset.FLAG_COL])
+
+    if conc is not None:
+        data_df = conc.reproject_df(data_df, census, concordance.is_intensive(characteristic))
+    return data_df
+
+
+def clip_df_column(unclipped_column, df, stats=None):
     """
     Adds a column of clipped values to a dataframe
     :param unclipped_column: The name of the column containing unclipped data
     :param df: The dataframe to modify
+    :param stats: A dataframe of precomputed statistics of each column, see clip_outliers
     :return: The name of the column added to the dataframe
     """
     column = unclipped_column + " clipped"
-    df[unclipped_column + " clipped"] = clip_outliers(df[unclipped_column])
+    quartiles = None
+    if stats is not None and unclipped_column in stats.index:
+        quartiles = stats.loc[unclipped_column, ["q1", "q3"]].to_numpy()
+    df[unclipped_column + " clipped"] = clip_outliers(df[unclipped_column], quartiles)
     return column
 
 
-def proc_rows(census_data, function_name, func, cad, geo_level, strings):
+def proc_columns(census_data, data_dfs, function_name, func, cad, geo_level):
     """
-    Processes rows of a cad dataframe, populating a column for both annual data and function data
+    Populates a column of a cad dataframe for the data of each year and, if there are multiple years, for function data.
+    Only geographies with data in every year are populated, all other geographies are given a value of zero.
     :param census_data: A list of census objects
+    :param data_dfs: A list of dataframes holding the rows of the plotted characteristic for each census
     :param function_name: The name of the function used to operate on multiple years
-    :param func: The function that operates on data from multiple years
+    :param func: The function that operates on data from multiple years, given a matrix with a row for each year and a
+    column for each geography. If None, no function data is populated
     :param cad: The pandas dataframe containing data to be modified
     :param geo_level: The geographic level used
-    :param strings: A tuple of the characteristic names to be plotted
-    :return: None. The data within the cad object is modified
-    """
-    total = sum(
-        1 for _ in census_data[0].data_df.query(f"`{census_data[0].characteristic_col}` in @strings[0]").iterrows())
-    count = 0
-
-    for index, datum in census_data[0].data_df.query(
-            f"`{census_data[0].characteristic_col}` in @strings[0]").iterrows():
-        count += 1
-        print(f"Currently processing {count} of {total} data rows")
-
-        # Populate function data
-        try:
-            func_data = np.array([float(datum[census_data[0].total_col])])
-            for i in range(1, len(census_data)):
-                func_data = np.append(func_data, float(census_data[i].data_df.query(
-                    f"{census_data[i].geocode_col} == @datum['{census_data[0].geocode_col}']")[
-                                                           census_data[i].total_col]))
-
-            cad.loc[cad[geo_level] == datum[census_data[0].geocode_col], function_name] = func(func_data)
-        except (TypeError, ValueError):
-            # If there is a data quality issue, the data is given as a NAN
-            cad.loc[cad[geo_level] == datum[census_data[0].geocode_col], function_name] = np.NAN
-
-        # Populate annual data
-        for i in range(0, len(census_data)):
-            try:
-                cad.loc[cad[geo_level] == datum[census_data[0].geocode_col], str(census_data[i].year)] = float(
-                    census_data[i].data_df.query(
-                        f"{census_data[i].geocode_col} == @datum['{census_data[0].geocode_col}']")[
-                        census_data[i].total_col])
+    :return: A list of series holding the data quality flag of each year, followed by the flags of the function data
+    if it is populated. The data within the cad object is modified
+    """
+    values = []
+    flags = []
+    matched = np.ones(len(cad), dtype=bool)
+
+    for i, census in enumerate(census_data):
+        data_df = data_dfs[i].drop_duplicates(census.geocode_col).set_index(census.geocode_col)
+        matched &= cad[geo_level].isin(data_df.index).to_numpy()
+        values.append(cad[geo_level].map(data_df[dataset.VALUE_COL]).to_numpy(dtype=float, na_value=np.nan))
+        flags.append(cad[geo_level].map(data_df[dataset.FLAG_COL]).astype(object))
+
+    for i, census in enumerate(census_data):
+        cad[str(census.year)] = np.where(matched, values[i], 0)
+
+    if len(census_data) > 1 and func is not None:
+        cad[function_name] = np.where(matched, func(np.vstack(values)), 0)
 
-            except (TypeError, ValueError):
-                # If there is a data quality issue, the data is given as a NAN
-                cad.loc[cad[geo_level] == datum[census_data[0].geocode_col], str(census_data[i].year)] = np.NAN
+        flags.append(combine_flags(flags))
 
+    return flags
 
-def det_thresholds(cad, columns):
+
+def combine_flags(flags):
+    """
+    Combines the data quality flags of multiple years into the flags of function data, which is missing due to the
+    first flagged year
+    :param flags: A list of series holding the data quality flags of each year
+    :return: A series of flags
+    """
+    function_flags = flags[0]
+    for year_flags in flags[1:]:
+        function_flags = function_flags.where(function_flags.notna(), year_flags)
+    return function_flags
+
+
+def gen_display_column(cad, column, flags):
+    """
+    Adds a column of text to a cad dataframe for display within a hover bubble, where missing data is described by its
+    data quality flag
+    :param cad: The pandas dataframe to modify
+    :param column: The name of the column containing the data
+    :param flags: A series of the data quality flags of the data
+    :return: The name of the column added to the dataframe
+    """
+    display_column = column + " display"
+    cad[display_column] = cad[column].round(_ROUND_DECS).astype(str).where(cad[column].notna(),
+                                                                            flags.fillna(dataset.MISSING_FLAG))
+    return display_column
+
+
+def det_thresholds(cad, columns, stats=None):
     """
     Returns a np array of a threshold scale that can be used in a Folium legend
     :param cad: The cad data
     :param columns: A list of strings corresponding to columns in the cad data
+    :param stats: A dataframe of precomputed statistics of each column, see get_range
     :return: Threshold scale in the form of an np array
     """
-    minimum, maximum = get_range(cad, columns)
+    minimum, maximum = get_range(cad, columns, stats)
     step_size = (maximum - minimum) / _THRESHOLD_LEVELS
     thresholds = np.arange(minimum, maximum + step_size, step_size)
     return thresholds
 
 
-def get_range(df, columns):
+def get_range(df, columns, stats=None):
     """
     Determines the range of values seen in multiple columns of a pandas dataframe
     :param df: The dataframe
     :param columns: A string value of the columns to be considered
+    :param stats: A dataframe of precomputed statistics indexed by column. Columns within it are not scanned
     :return:
     """
 
     minimum, maximum = math.inf, -math.inf
     for column in columns:
-        if df[column].max() > maximum:
-            maximum = df[column].max()
-        if df[column].min() < minimum:
-            minimum = df[column].min()
+        if stats is not None and column in stats.index:
+            column_min, column_max = stats.loc[column, "min"], stats.loc[column, "max"]
+        else:
+            column_min, column_max = df[column].min(), df[column].max()
+        if column_max > maximum:
+            maximum = column_max
+        if column_min < minimum:
+            minimum = column_min
 
     return minimum, maximum
 
@@ -234,32 +324,51 @@ def get_property_names(type):
     return geo_level, geo_name, prop_name
 
 
-def get_cad_file(type):
+def get_cad_filename(type, width=None, tolerance=None):
     """
-    Reads the correct geopandas dataframe based on the type of geography desired
+    Gets the filename of the boundary file for a given type of census geography, at the level of detail that suits the
+    map. If the boundaries have not been simplified (see simplify.py), the original simplified boundaries are used.
     :param type: A string representing the type of geography desired: "Census Subdivisions", "Census Divisions", or "Provinces"
-    :return: A geopandas dataframe
+    :param width: The width of a map of Canada in pixels. If None, the map is interactive
+    :param tolerance: The tolerance of the level of detail in metres, overriding the level selected for the width
+    :return: The filename as a string
     """
-    if type == "Census Subdivisions":
-        cad = gpd.read_file("mapData/simplified/Census Sub Divisions/lcsd000b21a_e.shp")
-    elif type == "Provinces":
-        cad = gpd.read_file("mapData/simplified/Provinces/lpr_000b21a_e.shp")
-    elif type == "Census Divisions":
-        cad = gpd.read_file("mapData/simplified/Census Divisions/lcd_000b21a_e.shp")
-    else:
+    if type not in _CAD_FILENAMES:
         raise ValueError("Incorrect type provided")
-    return cad
+
+    if tolerance is None:
+        tolerance = simplify.select_tolerance(type, width)
+
+    filename = simplify.get_simplified_filename(type, tolerance)
+    return filename if os.path.isfile(filename) else _CAD_FILENAMES[type]
+
+
+def get_cad_file(type, width=None, tolerance=None):
+    """
+    Reads the correct geopandas dataframe based on the type of geography desired. Files are only read once, after
+    which a copy is returned
+    :param type: A string representing the type of geography desired: "Census Subdivisions", "Census Divisions", or "Provinces"
+    :param width: The width of a map of Canada in pixels, see get_cad_filename
+    :param tolerance: The tolerance of the level of detail in metres, see get_cad_filename
+    :return: A geopandas dataframe
+    """
+    filename = get_cad_filename(type, width, tolerance)
+    if filename not in _cad_cache:
+        _cad_cache[filename] = gpd.read_file(filename)
+    return _cad_cache[filename].copy()
 
 
-def output_map(m):
+def output_map(m, filename="map.html", open_browser=True):
     """
     Saves and opens a folium map
     :param m: A folium map
+    :param filename: The html file the map is saved to
+    :param open_browser: Should the map be opened within a browser?
     :return: None
     """
-    outfp = "map.html"
-    m.save(outfp)
-    webbrowser.open("map.html")
+    m.save(filename)
+    if open_browser:
+        webbrowser.open(filename)
 
 
 def gen_choropleth(data, column_1, column_2, key_on, legend_name, name, thresholds=None, show=True):
@@ -346,10 +455,11 @@ def gen_layer_controller():
     return lc
 
 
-def gen_hover_bubble(data, hover_fields):
+def gen_hover_bubble(data, hover_fields, aliases=None):
     """
     Creates a hover bubble that may be applied to a folium map
     :param hover_fields: The fields of the data that should be displayed within the hover bubble
+    :param aliases: The names the fields are displayed with. Defaults to the names of the fields
     :return: A GeoJson object representing a hover bubble
     """
 
@@ -373,7 +483,7 @@ def gen_hover_bubble(data, hover_fields):
         highlight_function=highlight_function,
         tooltip=folium.features.GeoJsonTooltip(
             fields=hover_fields,
-            aliases=hover_fields,
+            aliases=hover_fields if aliases is None else aliases,
             style="background-color: white; color: #333333; font-family: arial; font-size: 12px; padding: 10px;"
         )
     )
@@ -381,42 +491,53 @@ def gen_hover_bubble(data, hover_fields):
 
 
 def mean_difference(data):
-    diffs = []
-
-    for i in range(1, len(data)):
-        diffs.append(data[i] - data[i - 1])
-
-    return np.round(np.mean(diffs), _ROUND_DECS)
+    """
+    Determines the mean of the differences between consecutive years
+    :param data: An array of data, where the first axis is the year. Further axes are processed independently.
+    :return: The mean difference, rounded
+    """
+    data = np.asarray(data, dtype=float)
+    return np.round(np.mean(np.diff(data, axis=0), axis=0), _ROUND_DECS)
 
 
 def mean_percent_difference(data):
-    diffs = []
-    for i in range(1, len(data)):
-        if np.mean((data[i], data[i - 1])) == 0:
-            diffs.append(np.NAN)
-        else:
-            diffs.append((data[i] - data[i - 1]) / (np.mean((data[i], data[i - 1]))) * 100)
+    """
+    Determines the mean of the percent differences between consecutive years, relative to the mean of both years
+    :param data: An array of data, where the first axis is the year. Further axes are processed independently.
+    :return: The mean percent difference, rounded. NAN if the mean of any two consecutive years is zero
+    """
+    data = np.asarray(data, dtype=float)
+    means = (data[1:] + data[:-1]) / 2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        diffs = np.where(means == 0, np.nan, np.diff(data, axis=0) / means * 100)
 
-    return np.round(np.mean(diffs), _ROUND_DECS)
+    return np.round(np.mean(diffs, axis=0), _ROUND_DECS)
 
 
 def mean_percent_change(data):
-    diffs = []
-    for i in range(1, len(data)):
-        if np.abs(data[i - 1]) == 0:
-            diffs.append(np.NAN)
-        else:
-            diffs.append((data[i] - data[i - 1]) / (np.abs(data[i - 1])) * 100)
+    """
+    Determines the mean of the percent changes between consecutive years, relative to the earlier year
+    :param data: An array of data, where the first axis is the year. Further axes are processed independently.
+    :return: The mean percent change, rounded. NAN if any year other than the last is zero
+    """
+    data = np.asarray(data, dtype=float)
+    priors = np.abs(data[:-1])
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        diffs = np.where(priors == 0, np.nan, np.diff(data, axis=0) / priors * 100)
 
-    return np.round(np.mean(diffs), _ROUND_DECS)
+    return np.round(np.mean(diffs, axis=0), _ROUND_DECS)
 
 
-def clip_outliers(df):
+def clip_outliers(df, quartiles=None):
     """
     Removes outliers for a pandas dataframe based on usage of the interquartile range
     :param df: The dataframe for outliers to be removed from
+    :param quartiles: The precomputed first and third quartiles of the data. If None, they are computed
     :return:The dataframe with outliers clipped
     """
-    iqr = df.quantile(0.75) - df.quantile(0.25)
+    q1, q3 = (df.quantile(0.25), df.quantile(0.75)) if quartiles is None else quartiles
+    iqr = q3 - q1
     # Clip data that is 3 iqrs beyond the first or third quartile
-    return df.clip(df.quantile(0.25) - 3 * iqr, df.quantile(0.75) + 3 * iqr)
+    return df.clip(q1 - 3 * iqr, q3 + 3 * iqr)
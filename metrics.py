@@ -0,0 +1,209 @@
+import ast
+import operator
+import re
+import numpy as np
+import pandas as pd
+import dataset
+
+# Characteristics are referenced by their paths within square brackets, see dataset.resolve_path
+# For example: [Total - Private households by tenure > Renter] / [Total - Private households by tenure] * 1000
+_PATH_PATTERN = re.compile(r"\[([^\[\]]+)]")
+_PLACEHOLDER = "_path_"
+_BINARY_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul, ast.Div: operator.truediv}
+_UNARY_OPERATORS = {ast.USub: operator.neg, ast.UAdd: operator.pos}
+# Functions that operate on the children of a characteristic
+_SUBTREE_FUNCTIONS = ("sum",)
+
+
+class Metric:
+    """
+    A metric derived from the values of characteristics, such as a ratio or a per capita rate
+    """
+
+    def __init__(self, expression, name=None):
+        """
+        :param expression: The expression that defines the metric. Supports characteristic paths within square brackets,
+        numbers, + - * / and parentheses, and sum([path]) to add the values of the children of a characteristic.
+        :param name: The name of the metric. Defaults to the expression
+        """
+        self.expression = expression
+        self.name = name if name is not None else expression
+
+        paths = []
+
+        def replace_path(match):
+            # Paths are normalized so that equivalent sub-expressions share a cache key
+            parts = match.group(1).split(dataset.PATH_SEPARATOR)
+            paths.append(dataset.PATH_SEPARATOR.join(part.strip() for part in parts))
+            return f"{_PLACEHOLDER}{len(paths) - 1}"
+
+        try:
+            tree = ast.parse(_PATH_PATTERN.sub(replace_path, expression).strip(), mode="eval")
+        except SyntaxError as e:
+            raise ValueError(f"Invalid metric expression: {expression}") from e
+
+        self.paths = paths
+        self.compiled = self._compile(tree.body)
+
+    def _compile(self, node):
+        """
+        Compiles an expression into nested tuples, which also serve as the keys used to cache sub-expressions
+        :param node: A node of the abstract syntax tree of the expression
+        :return: A tuple of the operation followed by its operands
+        """
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY_OPERATORS:
+            return type(node.op).__name__, self._compile(node.left), self._compile(node.right)
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY_OPERATORS:
+            return type(node.op).__name__, self._compile(node.operand)
+        elif isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return "const", float(node.value)
+        elif isinstance(node, ast.Name) and node.id.startswith(_PLACEHOLDER):
+            return "path", self.paths[int(node.id[len(_PLACEHOLDER):])]
+        elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in _SUBTREE_FUNCTIONS
+              and len(node.args) == 1 and not node.keywords and isinstance(node.args[0], ast.Name)
+              and node.args[0].id.startswith(_PLACEHOLDER)):
+            return node.func.id, self._compile(node.args[0])[1]
+
+        raise ValueError(f"Unsupported term within metric expression: {self.expression}")
+
+    def __str__(self):
+        return self.name
+
+
+class Evaluator:
+    """
+    Evaluates metrics over the data of censuses. The values needed by a batch of metrics are read at once, and both the
+    values and the results of sub-expressions are cached so that they are only computed once across metrics. An
+    evaluator is kept across calls (see map_plot.read_data) so that the cache is shared by every map that is made.
+    """
+
+    def __init__(self, geocodes=None):
+        """
+        :param geocodes: The geocodes to evaluate metrics for. If None, metrics are evaluated for all geographies.
+        """
+        self.geocodes = None if geocodes is None else [str(geocode) for geocode in geocodes]
+        self._values = {}
+        self._flags = {}
+        self._results = {}
+
+    def evaluate(self, metric_list, census):
+        """
+        Evaluates metrics for a census
+        :param metric_list: A list of metrics
+        :param census: The census to evaluate the metrics with
+        :return: A list of dataframes, one per metric, in the same form as returned by dataset.read_values
+        """
+        self._read_values(census, [dataset.resolve_path(census.char_tree, path) for metric in metric_list
+                                   for path in metric.paths])
+
+        data_dfs = []
+        for metric in metric_list:
+            values = self._evaluate(metric.compiled, census)
+            data_dfs.append(pd.DataFrame({census.geocode_col: values.index,
+                                          census.characteristic_col: metric.name,
+                                          dataset.VALUE_COL: values.to_numpy(),
+                                          dataset.FLAG_COL: self._get_flags(metric, census, values).to_numpy()}))
+        return data_dfs
+
+    def _get_flags(self, metric, census, values):
+        """
+        Gets the data quality flags of a metric, which is missing due to the first flagged characteristic it refers to
+        :param metric: The metric
+        :param census: The census the metric was evaluated with
+        :param values: A series of the values of the metric, see _evaluate
+        :return: A series of flags indexed by geocode, None where the metric has a value
+        """
+        matrix = self._flags[census.year]
+        flags = pd.Series(None, index=values.index, dtype=object)
+        for node in self._get_nodes(metric.compiled, census):
+            flags = flags.combine_first(matrix[node].reindex(values.index))
+
+        # Values may also be missing due to a division by zero
+        flags[flags.isna()] = dataset.MISSING_FLAG
+        flags[values.notna()] = None
+        return flags
+
+    def _get_nodes(self, compiled, census):
+        """
+        Gets the nodes whose values a compiled expression is evaluated from
+        :param compiled: A compiled expression, see Metric._compile
+        :param census: The census to evaluate the expression with
+        :return: A list of nodes, in the order they appear within the expression
+        """
+        operation = compiled[0]
+        if operation == "const":
+            return []
+        elif operation == "path":
+            return [dataset.resolve_path(census.char_tree, compiled[1])]
+        elif operation == "sum":
+            return list(dataset.resolve_path(census.char_tree, compiled[1]).children)
+        return [node for term in compiled[1:] for node in self._get_nodes(term, census)]
+
+    def _read_values(self, census, nodes):
+        """
+        Reads the values and flags of characteristics and their children that are not already cached into matrices of
+        geographies by characteristics
+        :param census: The census to read from
+        :param nodes: The nodes of the characteristics
+        :return: None
+        """
+        nodes = {n for node in nodes for n in (node,) + node.children}
+        matrix = self._values.get(census.year)
+        if matrix is not None:
+            nodes = [node for node in nodes if node not in matrix.columns]
+        if len(nodes) == 0:
+            return
+
+        data_df = dataset.read_values(census, list(nodes), self.geocodes,
+                                      [census.geocode_col, dataset.CHAR_INDEX_COL, dataset.VALUE_COL,
+                                       dataset.FLAG_COL])
+        data_df = data_df.drop_duplicates([census.geocode_col, dataset.CHAR_INDEX_COL])
+        data_df = data_df.set_index([census.geocode_col, dataset.CHAR_INDEX_COL])
+        char_indices = dataset.get_char_indices(census.char_tree)
+
+        for cache, column in ((self._values, data_df[dataset.VALUE_COL].astype(float)),
+                              (self._flags, data_df[dataset.FLAG_COL].astype(object))):
+            values = column.unstack()
+
+            # Label columns by node rather than by index
+            values = values.reindex(columns=[char_indices[node] for node in nodes])
+            values.columns = nodes
+
+            if self.geocodes is not None:
+                values = values.reindex(self.geocodes)
+
+            matrix = cache.get(census.year)
+            cache[census.year] = values if matrix is None else matrix.join(values, how="outer")
+
+    def _evaluate(self, compiled, census):
+        """
+        Evaluates a compiled expression, using the cached result if it has already been evaluated
+        :param compiled: A compiled expression, see Metric._compile
+        :param census: The census to evaluate the expression with
+        :return: A series of values indexed by geocode
+        """
+        key = (census.year, compiled)
+        if key in self._results:
+            return self._results[key]
+
+        matrix = self._values[census.year]
+        operation = compiled[0]
+
+        if operation == "const":
+            result = pd.Series(compiled[1], index=matrix.index)
+        elif operation == "path":
+            result = matrix[dataset.resolve_path(census.char_tree, compiled[1])]
+        elif operation == "sum":
+            children = dataset.resolve_path(census.char_tree, compiled[1]).children
+            result = matrix[list(children)].sum(axis=1, skipna=False)
+        elif len(compiled) == 2:
+            result = _UNARY_OPERATORS[getattr(ast, operation)](self._evaluate(compiled[1], census))
+        else:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                result = _BINARY_OPERATORS[getattr(ast, operation)](self._evaluate(compiled[1], census),
+                                                                    self._evaluate(compiled[2], census))
+            # Division by zero gives no meaningful value
+            result = result.replace([np.inf, -np.inf], np.nan)
+
+        self._results[key] = result
+        return result
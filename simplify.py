@@ -0,0 +1,107 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import geopandas as gpd
+import shapely
+from manifest import Manifest
+
+# Simplifies the boundary files provided by statistics canada to multiple levels of detail. Each layer is simplified
+# as a coverage, so borders shared by neighbouring geographies are simplified identically and no gaps or slivers form.
+# Source for boundary files: https://www12.statcan.gc.ca/census-recensement/2021/geo/sip-pis/boundary-limites/index2021-eng.cfm
+RAW_FILENAMES = {"Census Subdivisions": "mapData/raw/lcsd000b21a_e.shp",
+                 "Census Divisions": "mapData/raw/lcd_000b21a_e.shp",
+                 "Provinces": "mapData/raw/lpr_000b21a_e.shp"}
+# Tolerances of each level of detail, in metres
+TOLERANCES = (100, 500, 2500, 10000)
+_SIMPLIFIED_DIR = "mapData/simplified"
+_CRS = "EPSG:3347"
+_CANADA_WIDTH = 5.5e6
+# Interactive maps may be zoomed, so they use the finest detail that keeps the map responsive for the geography
+_INTERACTIVE_TOLERANCES = {"Census Subdivisions": 100, "Census Divisions": 500, "Provinces": 2500}
+
+
+def get_simplified_filename(type, tolerance):
+    """
+    Gets the filename of a simplified boundary file
+    :param type: A string representing the type of geography: "Census Subdivisions", "Census Divisions", or "Provinces"
+    :param tolerance: The tolerance the boundaries were simplified with, in metres
+    :return: The filename as a string
+    """
+    return os.path.join(_SIMPLIFIED_DIR, f"{tolerance}m", type, os.path.basename(RAW_FILENAMES[type]))
+
+
+def select_tolerance(type, width=None):
+    """
+    Selects the level of detail that suits a map
+    :param type: A string representing the type of geography: "Census Subdivisions", "Census Divisions", or "Provinces"
+    :param width: The width of a map of Canada in pixels. If None, the map is interactive.
+    :return: The tolerance of the level of detail, in metres
+    """
+    if width is None:
+        return _INTERACTIVE_TOLERANCES[type]
+
+    # Use the coarsest level whose detail is still finer than a pixel
+    pixel_size = _CANADA_WIDTH / width
+    suitable = [tolerance for tolerance in TOLERANCES if tolerance <= pixel_size]
+    return max(suitable) if suitable else min(TOLERANCES)
+
+
+def simplify_layer(type, tolerance):
+    """
+    Simplifies a boundary file, preserving the borders shared by neighbouring geographies
+    :param type: A string representing the type of geography: "Census Subdivisions", "Census Divisions", or "Provinces"
+    :param tolerance: The tolerance to simplify the boundaries with, in metres
+    :return: The filename of the simplified boundary file
+    """
+    filename = get_simplified_filename(type, tolerance)
+    cad = gpd.read_file(RAW_FILENAMES[type]).to_crs(_CRS)
+
+    cad.geometry = shapely.coverage_simplify(cad.geometry.to_numpy(), tolerance)
+
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    cad.to_file(filename)
+    return filename
+
+
+def simplify_boundaries(processes=None):
+    """
+    Simplifies every boundary file at every tolerance in parallel. Outputs are recorded within the manifest, so only
+    levels whose boundary file changed are simplified again. Boundary files that have not been downloaded are skipped.
+    :param processes: The number of processes to use. Defaults to the number of cpus
+    :return: None
+    """
+    manifest = Manifest()
+    stale = {}
+
+    for type, raw_filename in RAW_FILENAMES.items():
+        if not os.path.isfile(raw_filename):
+            print(f"No boundary file found at {raw_filename}, the prior simplified boundaries will be used")
+            continue
+
+        for tolerance in TOLERANCES:
+            inputs = {"boundaries": manifest.fingerprint(raw_filename), "tolerance": tolerance}
+            # The whole directory is tracked, as a shapefile is made up of several files
+            if not manifest.is_current("simplify", f"{type} {tolerance}m", inputs,
+                                       [os.path.dirname(get_simplified_filename(type, tolerance))]):
+                stale[(type, tolerance)] = inputs
+
+    if not stale:
+        return
+
+    # Layers are simplified as a whole, as simplifying each province separately would break the borders between them
+    with ProcessPoolExecutor(processes) as executor:
+        futures = {executor.submit(simplify_layer, type, tolerance): (type, tolerance) for type, tolerance in stale}
+
+        for future in as_completed(futures):
+            type, tolerance = futures[future]
+            manifest.record("simplify", f"{type} {tolerance}m", stale[(type, tolerance)],
+                            [os.path.dirname(future.result())])
+            print(f"Simplified {type} to {tolerance}m")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simplify the census boundary files to multiple levels of detail")
+    parser.add_argument("--processes", type=int, help="The number of processes to use")
+    args = parser.parse_args()
+
+    simplify_boundaries(args.processes)
@@ -0,0 +1,196 @@
+import argparse
+import functools
+import gzip
+import http.server
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import shapely
+from anytree import PreOrderIter
+import census
+import constants
+import cube
+import dataset
+import main
+import map_plot
+
+# Exports a static site that covers every characteristic of every census. Geometry is written once per geography, and
+# the values of each characteristic are written as a small compressed shard per census year and geography, which the
+# client page only fetches once the characteristic is picked.
+# Shards are stored as data/{year}/{geography}/{char_index}.json.gz, see write_shards for their format.
+_TEMPLATE_FILENAME = "site/index.html"
+_SITE_CRS = "EPSG:4326"
+# Coordinates are rounded to roughly ten metres, which is finer than the interactive level of detail
+_GRID_SIZE = 1e-4
+_DECIMALS = 4
+_NODES_PER_TASK = 500
+
+
+def get_slug(type):
+    """
+    Gets the name used for a type of geography within the paths of the site
+    :param type: A string representing the type of geography: "Census Subdivisions", "Census Divisions", or "Provinces"
+    :return: The name as a string
+    """
+    return type.lower().replace(" ", "-")
+
+
+def _write_json(filename, data):
+    """
+    Writes gzip compressed json
+    :param filename: The file to write
+    :param data: A json serializable object
+    :return: None
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, "wb") as file:
+        # A fixed modification time keeps the output identical between exports, so unchanged files deploy as unchanged
+        file.write(gzip.compress(json.dumps(data, separators=(",", ":")).encode(), mtime=0))
+
+
+def write_geometry(output_dir, type):
+    """
+    Writes the geometry of a type of geography as a geojson file. The order of its features is the order of the values
+    within every shard of the geography.
+    :param output_dir: The directory of the site
+    :param type: A string representing the type of geography
+    :return: None
+    """
+    geo_level, geo_name, _ = map_plot.get_property_names(type)
+    cad = map_plot.get_cad_file(type).to_crs(_SITE_CRS)[[geo_level, geo_name, "geometry"]]
+    cad = cad.rename(columns={geo_level: "id", geo_name: "name"})
+    cad["id"] = cad["id"].astype(str)
+    cad.geometry = shapely.set_precision(cad.geometry.to_numpy(), _GRID_SIZE)
+
+    _write_json(os.path.join(output_dir, "geometry", get_slug(type) + ".geojson.gz"),
+                json.loads(cad.to_json(drop_id=True)))
+
+
+def get_tree(node, char_indices):
+    """
+    Converts a characteristic tree to nested dictionaries, where n is the name of a characteristic, i is its index, and
+    c holds its children
+    :param node: The node to convert
+    :param char_indices: The index of every node, see dataset.get_char_indices
+    :return: A dictionary
+    """
+    tree = {"n": dataset.get_label(node).strip(), "i": char_indices[node]}
+    if node.children:
+        tree["c"] = [get_tree(child, char_indices) for child in node.children]
+    return tree
+
+
+def write_tree(output_dir, cen):
+    """
+    Writes the characteristic tree of a census
+    :param output_dir: The directory of the site
+    :param cen: The census
+    :return: None
+    """
+    char_indices = dataset.get_char_indices(cen.char_tree)
+    _write_json(os.path.join(output_dir, "tree", f"{cen.year}.json.gz"),
+                [get_tree(child, char_indices) for child in cen.char_tree.children])
+
+
+def write_shards(output_dir, year, type, start, stop):
+    """
+    Writes the shards of a range of characteristics. Each shard holds v, the value of each feature of the geometry of
+    the geography (null where there is no value), and f, the data quality flag of each feature without a value.
+    :param output_dir: The directory of the site
+    :param year: The census year
+    :param type: A string representing the type of geography
+    :param start: The index of the first characteristic
+    :param stop: The index after the last characteristic
+    :return: The number of shards written
+    """
+    cen = census.get_censuses([year])[0]
+    geo_level = map_plot.get_property_names(type)[0]
+    geocodes = map_plot.get_cad_file(type)[geo_level].astype(str).to_numpy()
+    nodes = list(PreOrderIter(cen.char_tree))[start + 1:stop + 1]
+    char_indices = dataset.get_char_indices(cen.char_tree)
+
+    values, flags, present = cube.read_matrix(cen, nodes, geocodes, type)
+    values = np.where(present[:, None], values, np.nan)
+    values = np.round(values, _DECIMALS)
+
+    for j, node in enumerate(nodes):
+        missing = np.flatnonzero(np.isnan(values[:, j]))
+        shard = {"v": [None if np.isnan(value) else value for value in values[:, j].tolist()],
+                 "f": {str(i): flags[i, j] for i in missing if not pd.isna(flags[i, j])}}
+        _write_json(os.path.join(output_dir, "data", str(year), get_slug(type), f"{char_indices[node]}.json.gz"),
+                    shard)
+
+    return len(nodes)
+
+
+def export_site(output_dir, years=None, types=constants.GEOGRAPHIES, processes=None):
+    """
+    Exports a static site, which may be served by any web server
+    :param output_dir: The directory to write the site to
+    :param years: The census years to export. If None, every census is exported
+    :param types: The types of geography to export
+    :param processes: The number of processes used to write shards. Defaults to the number of cpus
+    :return: None
+    """
+    cen = census.censuses if years is None else census.get_censuses(years)
+
+    os.makedirs(output_dir, exist_ok=True)
+    shutil.copyfile(_TEMPLATE_FILENAME, os.path.join(output_dir, "index.html"))
+    with open(os.path.join(output_dir, "site.json"), "w") as file:
+        json.dump({"years": [census_data.year for census_data in cen],
+                   "geographies": [{"name": type, "slug": get_slug(type)} for type in types]}, file)
+
+    for type in types:
+        print(f"Writing geometry of {type}")
+        write_geometry(output_dir, type)
+
+    tasks = []
+    for census_data in cen:
+        write_tree(output_dir, census_data)
+        n_nodes = len(dataset.get_char_indices(census_data.char_tree))
+        tasks.extend((census_data.year, type, start, min(start + _NODES_PER_TASK, n_nodes))
+                     for type in types for start in range(0, n_nodes, _NODES_PER_TASK))
+
+    with ProcessPoolExecutor(processes, initializer=main.init_worker) as executor:
+        futures = [executor.submit(write_shards, output_dir, *task) for task in tasks]
+
+        count = 0
+        for future in as_completed(futures):
+            count += future.result()
+            print(f"Written {count} shards")
+
+
+def serve(output_dir, port):
+    """
+    Serves a site from a local http server until interrupted
+    :param output_dir: The directory of the site
+    :param port: The port to serve on
+    :return: None
+    """
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=output_dir)
+    with http.server.ThreadingHTTPServer(("localhost", port), handler) as server:
+        print(f"Serving {output_dir} at http://localhost:{port}/")
+        server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export a static site of every census characteristic")
+    parser.add_argument("--output", default="site_export", help="The directory to write the site to")
+    parser.add_argument("--years", type=int, nargs="+", help="The census years to export")
+    parser.add_argument("--geography", nargs="+", default=list(constants.GEOGRAPHIES), choices=constants.GEOGRAPHIES)
+    parser.add_argument("--processes", type=int, help="The number of processes used to write shards")
+    parser.add_argument("--serve", action="store_true", help="Serve the site from a local http server afterwards")
+    parser.add_argument("--serve-only", action="store_true", help="Serve a previously exported site")
+    parser.add_argument("--port", type=int, default=8000, help="The port to serve the site on")
+    args = parser.parse_args()
+
+    if not args.serve_only:
+        main.process_data()
+        main.load_data()
+        export_site(args.output, args.years, args.geography, args.processes)
+
+    if args.serve or args.serve_only:
+        serve(args.output, args.port)
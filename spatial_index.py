@@ -0,0 +1,258 @@
+import argparse
+import os
+import pickle
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import shapely
+from pyproj import Transformer
+import census
+import constants
+import dataset
+import main
+import map_plot
+import metrics
+import simplify
+from manifest import Manifest
+
+# Looks up the census geography that contains each of a large number of points. The geometry of each geography type is
+# indexed with an STRtree, and points are queried against it in bulk.
+_POINT_CRS = "EPSG:4326"
+_CHUNK_SIZE = 1000000
+# Files smaller than this are looked up within a single process, as starting a pool would take longer
+_PARALLEL_BYTES = 100 * 2 ** 20
+GEOCODE_COL = "geocode"
+
+# The index and values of each worker process, see _init_worker
+_worker = None
+
+
+class SpatialIndex:
+    """
+    An STRtree over the boundaries of a type of census geography
+    """
+
+    def __init__(self, type):
+        """
+        :param type: A string representing the type of geography desired: "Census Subdivisions", "Census Divisions", or "Provinces"
+        """
+        with open(build_index(type), "rb") as file:
+            index = pickle.load(file)
+
+        self.type = type
+        self.geocodes = index["geocodes"]
+        self.tree = shapely.STRtree(shapely.from_wkb(index["geometries"]))
+        self.transformer = Transformer.from_crs(_POINT_CRS, index["crs"], always_xy=True)
+
+    def lookup(self, lat, lon):
+        """
+        Finds the geography that contains each point
+        :param lat: An array of latitudes
+        :param lon: An array of longitudes
+        :return: An array of the geocode of each point, None for points outside of every geography
+        """
+        x, y = self.transformer.transform(np.asarray(lon, dtype=float), np.asarray(lat, dtype=float))
+        point_indices, geometry_indices = self.tree.query(shapely.points(x, y), predicate="intersects")
+
+        # Points on a shared boundary intersect multiple geographies, only the first is kept
+        point_indices, first = np.unique(point_indices, return_index=True)
+
+        geocodes = np.full(len(x), None, dtype=object)
+        geocodes[point_indices] = self.geocodes[geometry_indices[first]]
+        return geocodes
+
+
+def build_index(type):
+    """
+    Builds the spatial index of a type of census geography. The index is cached to a file, which is rebuilt when the
+    boundary file changes.
+    :param type: A string representing the type of geography desired: "Census Subdivisions", "Census Divisions", or "Provinces"
+    :return: The filename of a pickle holding the geocodes, geometries and coordinate reference system of the geography
+    """
+    filename = os.path.join(constants.CACHE_DIR, f"{type} index.pickle")
+    manifest = Manifest()
+    # Points are looked up against the unsimplified boundaries, as simplification moves borders by up to its tolerance.
+    # The finest simplified level is only used if the raw boundary file has not been downloaded
+    boundaries = simplify.RAW_FILENAMES[type]
+    if not os.path.isfile(boundaries):
+        boundaries = map_plot.get_cad_filename(type, tolerance=min(simplify.TOLERANCES))
+    # The geocodes are held within the dbf file of the shapefile
+    attributes = os.path.splitext(boundaries)[0] + ".dbf"
+    inputs = {"boundaries": boundaries, "hash": manifest.fingerprint(boundaries),
+              "attributes": manifest.fingerprint(attributes)}
+
+    if not manifest.is_current("spatial index", type, inputs, [filename]):
+        print(f"Building spatial index for {type}")
+        geo_level = map_plot.get_property_names(type)[0]
+        cad = gpd.read_file(boundaries)
+
+        os.makedirs(constants.CACHE_DIR, exist_ok=True)
+        with open(filename, "wb") as file:
+            pickle.dump({"geocodes": cad[geo_level].astype(str).to_numpy(dtype=object),
+                         "geometries": shapely.to_wkb(cad.geometry.to_numpy()),
+                         "crs": cad.crs.to_wkt()}, file)
+        manifest.record("spatial index", type, inputs, [filename])
+
+    return filename
+
+
+def get_values(strings, census_data, geocodes=None, type="Census Subdivisions"):
+    """
+    Gets the values of characteristics for every geography. As within maps, the data of older censuses is
+    interpolated onto the 2021 geographies that points are looked up against.
+    :param strings: A tuple of the characteristic names or derived metrics, one per census
+    :param census_data: A list of census objects
+    :param geocodes: The geocodes to get values for. If None, values for all geographies are read.
+    :param type: The type of geography
+    :return: A dataframe indexed by geocode, with a column of values for each census year
+    """
+    values = pd.DataFrame(index=pd.Index([], name=GEOCODE_COL))
+
+    for i, cen in enumerate(census_data):
+        data_df = map_plot.read_data(cen, strings[i], geocodes, type)
+        data_df = data_df.drop_duplicates(cen.geocode_col).set_index(cen.geocode_col)
+        values = values.join(data_df[dataset.VALUE_COL].astype(float).rename(str(cen.year)), how="outer")
+
+    return values
+
+
+def lookup_chunk(chunk, lat_col, lon_col, index, values):
+    """
+    Adds the geocode and characteristic values of each point to a chunk of points
+    :param chunk: A dataframe of points
+    :param lat_col: The column holding latitudes
+    :param lon_col: The column holding longitudes
+    :param index: The spatial index
+    :param values: The characteristic values of each geography, see get_values
+    :return: The chunk with additional columns
+    """
+    geocodes = index.lookup(chunk[lat_col].to_numpy(), chunk[lon_col].to_numpy())
+    chunk = chunk.assign(**{GEOCODE_COL: pd.array(geocodes, dtype="string")})
+    return chunk.join(values, on=GEOCODE_COL)
+
+
+def _init_worker(type, values, lat_col, lon_col):
+    """
+    Loads the spatial index within a worker process, see lookup_chunk for a description of the parameters
+    :param type: The type of geography to load the spatial index of
+    :return: None
+    """
+    global _worker
+    _worker = {"index": SpatialIndex(type), "values": values, "lat_col": lat_col, "lon_col": lon_col}
+
+
+def _lookup_worker_chunk(chunk):
+    return lookup_chunk(chunk, _worker["lat_col"], _worker["lon_col"], _worker["index"], _worker["values"])
+
+
+def _read_chunks(filename, chunk_size):
+    """
+    Reads a csv or parquet file in chunks
+    :param filename: The file to read
+    :param chunk_size: The number of rows per chunk
+    :return: A generator of dataframes
+    """
+    if filename.lower().endswith(".parquet"):
+        for batch_data in pq.ParquetFile(filename).iter_batches(batch_size=chunk_size):
+            yield batch_data.to_pandas()
+    else:
+        yield from pd.read_csv(filename, chunksize=chunk_size)
+
+
+def _bounded_map(executor, func, iterable, window):
+    """
+    Maps a function over an iterable with an executor, in order, while only keeping a limited number of items in flight
+    so that memory use is bounded
+    :return: A generator of results
+    """
+    futures = deque()
+    for item in iterable:
+        futures.append(executor.submit(func, item))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def lookup_file(input_filename, output_filename, lat_col, lon_col, type, strings, census_data,
+                chunk_size=_CHUNK_SIZE, processes=1):
+    """
+    Looks up the geography and characteristic values of every point within a file. Points are streamed through in
+    chunks, so files larger than memory may be processed.
+    :param input_filename: A csv or parquet file of points
+    :param output_filename: The csv or parquet file to write. It holds the input columns, the geocode of each point,
+    and a column of characteristic values for each census year
+    :param lat_col: The column holding latitudes
+    :param lon_col: The column holding longitudes
+    :param type: A string representing the type of geography desired: "Census Subdivisions", "Census Divisions", or "Provinces"
+    :param strings: A tuple of the characteristic names or derived metrics, one per census
+    :param census_data: A list of census objects
+    :param chunk_size: The number of points per chunk
+    :param processes: The number of processes to look up chunks with, if the file is large
+    :return: None
+    """
+    values = get_values(strings, census_data, type=type)
+    chunks = _read_chunks(input_filename, chunk_size)
+
+    if processes > 1 and os.path.getsize(input_filename) > _PARALLEL_BYTES:
+        executor = ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(type, values, lat_col, lon_col))
+        results = _bounded_map(executor, _lookup_worker_chunk, chunks, 2 * processes)
+    else:
+        executor = None
+        index = SpatialIndex(type)
+        results = (lookup_chunk(chunk, lat_col, lon_col, index, values) for chunk in chunks)
+
+    writer = None
+    count = 0
+    try:
+        for result in results:
+            if output_filename.lower().endswith(".parquet"):
+                table = pa.Table.from_pandas(result, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_filename, table.schema)
+                # Types inferred for each chunk may differ, so chunks follow the types of the first
+                writer.write_table(table.cast(writer.schema))
+            else:
+                result.to_csv(output_filename, mode="w" if count == 0 else "a", header=count == 0, index=False)
+
+            count += len(result)
+            print(f"Looked up {count} points")
+    finally:
+        if writer is not None:
+            writer.close()
+        if executor is not None:
+            executor.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Look up the census geography and data of points")
+    parser.add_argument("input", help="A csv or parquet file of points")
+    parser.add_argument("output", help="The csv or parquet file to write")
+    parser.add_argument("--lat", default="lat", help="The column holding latitudes")
+    parser.add_argument("--lon", default="lon", help="The column holding longitudes")
+    parser.add_argument("--geography", default=constants.GEOGRAPHIES[0], choices=constants.GEOGRAPHIES)
+    parser.add_argument("--years", type=int, nargs="+", default=[], help="The census years to add values from")
+    parser.add_argument("--characteristic", action="append", default=[],
+                        help="A characteristic name or [path] for each year")
+    parser.add_argument("--metric", help="A derived metric expression to add instead of characteristics")
+    parser.add_argument("--chunk-size", type=int, default=_CHUNK_SIZE, help="The number of points per chunk")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="The number of processes to use")
+    args = parser.parse_args()
+
+    main.process_data()
+    main.load_data()
+
+    cen = census.get_censuses(args.years)
+    if args.metric is not None:
+        strings = [metrics.Metric(args.metric)] * len(cen)
+    elif len(args.characteristic) == len(cen):
+        strings = args.characteristic
+    else:
+        parser.error("A characteristic must be given for every year, or a metric given instead")
+
+    lookup_file(args.input, args.output, args.lat, args.lon, args.geography, strings, cen, args.chunk_size,
+                args.processes)